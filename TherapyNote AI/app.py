@@ -1,63 +1,59 @@
 import os
-import sqlite3
+import threading
+import time
 from datetime import datetime
 from io import BytesIO
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet
-from openai import OpenAI
-import gradio as gr
-import tempfile
-import PyPDF2
-
-# Initialize OpenAI client
+import uuid
+from transcription import transcribe_long_audio, transcribe_chunk
+from live import LiveSession
+from extract import extract_text
+from reports import ReportStore
+from cache import ResultCache, content_key
+from summarize import condense_transcript
+from jobs import JobQueue
+from gateway import ApiGateway
+import metrics
+from metrics import timed, record_usage
+from db import Database, init_database, normalize_name, insert_session, get_session, get_session_record, save_summary_revision, fetch_history_page, search_history, fetch_patient_timeline, get_patient_summary, fetch_visits_after, save_patient_summary
+
+# Startup
+# gradio、openai、reportlab 在首次使用时才导入；OpenAI 客户端在第一次调用 API 时创建，
+# 数据库、缓存和任务队列由 setup() 初始化。导入本模块不会打开数据库或启动界面，
+# 批处理和基准测试等工具导入后先调用 setup()
 import dotenv
 dotenv.load_dotenv()
-api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=api_key)
 
+client = None
+gateway = None
+_client_lock = threading.Lock()
 
-# Database
-DB_PATH = "assistant.db"
+def get_client():
+    # 返回包装了 client 的 ApiGateway（限流、重试、超时、合并相同请求）；重试由 gateway 负责，客户端自身不重试
+    global client, gateway
+    with _client_lock:
+        if client is None:
+            from openai import OpenAI
+            client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+        if gateway is None or gateway.client is not client:
+            gateway = ApiGateway(client)
+            metrics.gauge("api_gateway", gateway.stats)
+    return gateway
 
-def init_database():
-    try:
-        # 确保数据库目录存在
-        db_dir = os.path.dirname(DB_PATH)
-        if db_dir and not os.path.exists(db_dir):
-            os.makedirs(db_dir)
-        
-        # 连接数据库
-        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-        c = conn.cursor()
-        
-        # 创建表
-        c.execute('''CREATE TABLE IF NOT EXISTS history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            visit_number INTEGER,
-            doctor TEXT,
-            patient TEXT,
-            date TEXT,
-            transcript TEXT,
-            summary TEXT,
-            diseases TEXT,
-            UNIQUE(patient, visit_number)
-        )''')
-        
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        print(f"Error initializing database: {e}")
-        return False
 
-# 初始化数据库
-
-if not init_database():
-    print("Failed to initialize database. The application may not work properly.")
-
-# 创建全局数据库连接
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-c = conn.cursor()
+# Database
+DB_PATH = "assistant.db"
+ARCHIVE_DB_PATH = "archive.db"   # archive.py 移出的旧转录，打开已归档的记录时按需 ATTACH
+db = None
+result_cache = None
+job_queue = None
+report_store = None
+_setup_lock = threading.Lock()
+
+# 转录/总结结果缓存；修改提示词或转录流程时需提升对应版本号
+TRANSCRIBE_MODEL = "whisper-1"
+TRANSCRIBE_VERSION = "v1"
+SUMMARY_MODEL = "gpt-4o"
+PROMPT_VERSION = "v1"
 
 # i18n
 i18n = {
@@ -67,6 +63,10 @@ i18n = {
         "date": "日期",
         "record": "录制/上传音频",
         "file": "上传文件",
+        "live": "实时录音（边录边转录）",
+        "live_transcript": "实时转录",
+        "live_pending": "段正在转录...",
+        "live_gap": "部分录音片段转录失败，转录中以 [...] 标出，请补充或重新录制：",
         "text": "手动输入文本 (可选)",
         "next": "下一步",
         "transcript": "转录文本",
@@ -77,6 +77,24 @@ i18n = {
         "new_chat": "新对话",
         "history": "历史记录",
         "refresh": "刷新历史记录",
+        "filter_patient": "按病人筛选",
+        "filter_doctor": "按医生筛选",
+        "date_from": "开始日期",
+        "date_to": "结束日期",
+        "filter_diagnosis": "按诊断筛选",
+        "prev_page": "上一页",
+        "next_page": "下一页",
+        "search": "搜索转录和总结",
+        "search_btn": "搜索",
+        "timeline_patient": "病人时间线（输入病人姓名）",
+        "timeline_btn": "查看时间线",
+        "timeline_refresh": "更新长期总结",
+        "timeline": "就诊时间线",
+        "longitudinal": "长期总结",
+        "longitudinal_pending": "次就诊尚未计入长期总结",
+        "longitudinal_queued": "已提交长期总结更新，稍后重新查看时间线",
+        "diagnoses": "诊断",
+        "no_visits": "没有找到该病人的就诊记录",
         "step1": "基本信息",
         "step2": "上传内容",
         "step3": "生成报告",
@@ -85,6 +103,8 @@ i18n = {
         "saving": "正在保存记录...",
         "report": "正在生成报告...",
         "complete": "完成！",
+        "queued": "排队中...",
+        "failed": "处理失败：",
         "required": "请填写所有必填字段",
         "input_required": "请至少提供一种输入方式（音频、文件或文本）"
     },
@@ -94,6 +114,10 @@ i18n = {
         "date": "Date",
         "record": "Record/Upload Audio",
         "file": "Upload File",
+        "live": "Live Recording (transcribed while recording)",
+        "live_transcript": "Live Transcript",
+        "live_pending": "segment(s) transcribing...",
+        "live_gap": "Some parts of the recording could not be transcribed and are marked [...]. Please fill them in or record again: ",
         "text": "Manual Input Text (Optional)",
         "next": "Next Step ",
         "transcript": "Transcript",
@@ -104,6 +128,24 @@ i18n = {
         "new_chat": "New Conversation",
         "history": "History",
         "refresh": "Refresh History",
+        "filter_patient": "Filter by Patient",
+        "filter_doctor": "Filter by Doctor",
+        "date_from": "From Date",
+        "date_to": "To Date",
+        "filter_diagnosis": "Filter by Diagnosis",
+        "prev_page": "Previous Page",
+        "next_page": "Next Page",
+        "search": "Search Transcripts and Summaries",
+        "search_btn": "Search",
+        "timeline_patient": "Patient Timeline (enter patient name)",
+        "timeline_btn": "View Timeline",
+        "timeline_refresh": "Update Longitudinal Summary",
+        "timeline": "Visit Timeline",
+        "longitudinal": "Longitudinal Summary",
+        "longitudinal_pending": "visit(s) not yet included in the longitudinal summary",
+        "longitudinal_queued": "Longitudinal summary update queued; reopen the timeline shortly",
+        "diagnoses": "Diagnoses",
+        "no_visits": "No visits found for this patient",
         "step1": "Basic Information",
         "step2": "Upload Content",
         "step3": "Generate Report",
@@ -112,6 +154,8 @@ i18n = {
         "saving": "Saving Record...",
         "report": "Generating Report...",
         "complete": "Complete!",
+        "queued": "Queued...",
+        "failed": "Processing failed: ",
         "required": "Please fill in all required fields",
         "input_required": "Please provide at least one input method (audio, file, or text)"
     }
@@ -120,51 +164,136 @@ i18n = {
 # Core Functions
 def transcribe_audio(audio_path, file_obj):
     if audio_path:
-        # 上传的是音频，送给 Whisper 识别
-        with open(audio_path, 'rb') as f:
-            resp = client.audio.transcriptions.create(file=f, model="whisper-1")
-            return resp.text
+        # 上传的是音频，长录音分段并发送给 Whisper 识别
+        with timed("stage", stage="transcribe", source="audio") as stats:
+            stats["bytes"] = os.path.getsize(audio_path)
+            key = content_key("transcript", TRANSCRIBE_MODEL, TRANSCRIBE_VERSION, path=audio_path)
+            text = result_cache.get_or_compute(
+                key, "transcript", lambda: transcribe_long_audio(get_client(), audio_path, model=TRANSCRIBE_MODEL, retries=0)
+            )
+            stats["chars"] = len(text)
+        return text
     elif file_obj:
-        # 上传的是文本文件
-        filename = file_obj.name.lower()
-        if filename.endswith('.txt'):
-            with open(file_obj.name, 'r', encoding='utf-8') as f:
-                return f.read()
-        elif filename.endswith('.pdf'):
-            import PyPDF2
-            reader = PyPDF2.PdfReader(file_obj.name)
-            text = ''
-            for page in reader.pages:
-                text += page.extract_text()
-            return text
-        elif filename.endswith('.docx'):
-            import docx
-            doc = docx.Document(file_obj.name)
-            text = ''
-            for para in doc.paragraphs:
-                text += para.text + '\\n'
-            return text
-        else:
-            raise ValueError("Unsupported file type: only .txt, .pdf, .docx supported!")
+        # 上传的是文本文件（可以是文件路径，也可以是带 name 属性的文件对象）
+        file_path = file_obj if isinstance(file_obj, str) else file_obj.name
+        with timed("stage", stage="transcribe", source="document") as stats:
+            stats["bytes"] = os.path.getsize(file_path)
+            text = extract_text(file_path)
+            stats["chars"] = len(text)
+        return text
     else:
         return ""
 
 
-def summarize_and_extract(text, info):
-    prompt = f"Patient Info: {info}\nTranscript: {text}\nPlease summarize the above dialogue in a medical report style and list possible diagnoses. The list need to contain the 1.Chief Complaint, 2. History of Present Illness, 3. Mental Status Examination, 4. Assessment, 5. Possible Diagnoses, 6. Recommendations, 7. Plan, 8. Follow-Up"
-    resp = client.chat.completions.create(model="gpt-4o", messages=[{"role": "user", "content": prompt}])
-    return resp.choices[0].message.content
-
-def generate_report(doctor, patient, date, session_id, transcript, summary):
-    # print(f"Generating Report: Doctor={doctor}, Patient={patient}, Date={date}, Session={session_id}")
+# Live recording
+# 每个正在录音的会话对应一个 LiveSession（保存在内存中，界面只保存会话 id）。
+# 标签页关闭或录音中断时不会触发 stop_recording：超过 LIVE_IDLE_SECONDS 没有收到音频的会话
+# 在开始或继续录音时被丢弃，页面关闭时（demo.unload）丢弃该页面的会话
+LIVE_IDLE_SECONDS = float(os.getenv("LIVE_IDLE_SECONDS", 300))
+live_sessions = {}
+live_owners = {}      # 页面 session_hash -> 会话 id
+_live_lock = threading.Lock()
+
+def pop_live_session(live_id):
+    with _live_lock:
+        for owner in [o for o, i in live_owners.items() if i == live_id]:
+            del live_owners[owner]
+        return live_sessions.pop(live_id, None)
+
+def discard_live_session(live_id):
+    session = pop_live_session(live_id)
+    if session is not None:
+        session.discard()
+
+def evict_idle_live_sessions(idle_seconds=LIVE_IDLE_SECONDS):
+    cutoff = time.monotonic() - idle_seconds
+    with _live_lock:
+        idle = [live_id for live_id, session in live_sessions.items() if session.last_fed < cutoff]
+    for live_id in idle:
+        discard_live_session(live_id)
+    return len(idle)
+
+def transcribe_live_window(data, name):
+    return transcribe_chunk(get_client(), data, name, model=TRANSCRIBE_MODEL, retries=0)
+
+
+SUMMARY_PROMPT = "Patient Info: {info}\nTranscript: {text}\nPlease summarize the above dialogue in a medical report style and list possible diagnoses. The list need to contain the 1.Chief Complaint, 2. History of Present Illness, 3. Mental Status Examination, 4. Assessment, 5. Possible Diagnoses, 6. Recommendations, 7. Plan, 8. Follow-Up"
+
+MERGED_SUMMARY_PROMPT = "Patient Info: {info}\nThe following are clinical notes taken from consecutive parts of one therapy session:\n{text}\nPlease summarize the above session in a medical report style and list possible diagnoses. The list need to contain the 1.Chief Complaint, 2. History of Present Illness, 3. Mental Status Examination, 4. Assessment, 5. Possible Diagnoses, 6. Recommendations, 7. Plan, 8. Follow-Up"
+
+def stream_summary(text, info):
+    # 逐段产出模型输出的增量文本；完整结果在流结束后才写入缓存
+    with timed("stage", stage="summarize") as stats:
+        stats["chars"] = len(text)
+        prompt = SUMMARY_PROMPT.format(info=info, text=text)
+        key = content_key("summary", SUMMARY_MODEL, PROMPT_VERSION, data=prompt)
+        cached = result_cache.get(key)
+        if cached is not None:
+            stats["cache"] = "hit"
+            yield cached
+            return
+
+        # 超长转录先分段总结，再用合并后的笔记生成最终报告
+        source, condensed = condense_transcript(get_client(), text, info, model=SUMMARY_MODEL)
+        if condensed:
+            prompt = MERGED_SUMMARY_PROMPT.format(info=info, text=source)
+
+        stats["cache"] = "miss"
+        parts = []
+        with timed("api", api="chat_stream") as api_stats:
+            start = time.perf_counter()
+            stream = get_client().chat.completions.create(
+                model=SUMMARY_MODEL, messages=[{"role": "user", "content": prompt}], stream=True,
+                stream_options={"include_usage": True}
+            )
+            for chunk in stream:
+                record_usage(api_stats, chunk)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if not parts:
+                        metrics.observe("api_first_token_seconds", time.perf_counter() - start, api="chat_stream")
+                    parts.append(delta)
+                    yield delta
+        result_cache.put(key, "summary", "".join(parts))
+
+LONGITUDINAL_PROMPT = "Patient: {patient}\nCurrent longitudinal summary:\n{previous}\n\nNew visits since that summary:\n{visits}\n\nPlease update the longitudinal summary of this patient's course of care with the new visits. Keep it concise and cover presenting problems over time, diagnoses and how they changed, treatments and recommendations, progress, and open issues for the next visit."
+LONGITUDINAL_BATCH = 10   # 每次 API 调用最多合并的就诊数
+
+def update_longitudinal_summary(patient, retries=3):
+    # 只把尚未计入的就诊（通常只有刚保存的一次）合并进已有的长期总结，不重新总结全部历史
+    patient = normalize_name(patient)
+    conflicts = 0
+    with timed("stage", stage="longitudinal") as stats:
+        while True:
+            state = get_patient_summary(db, patient)
+            visits = fetch_visits_after(db, patient, state["last_record_id"], LONGITUDINAL_BATCH)
+            if not visits:
+                return state["summary"]
+            text = "\n\n".join(
+                f"Visit #{v['visit_number']} ({v['date']}, {v['doctor']}):\n{v['summary']}" for v in visits
+            )
+            prompt = LONGITUDINAL_PROMPT.format(patient=patient, previous=state["summary"] or "(none)", visits=text)
+            with timed("api", api="chat") as api_stats:
+                resp = get_client().chat.completions.create(
+                    model=SUMMARY_MODEL, messages=[{"role": "user", "content": prompt}]
+                )
+                record_usage(api_stats, resp)
+            stats["visits"] = stats.get("visits", 0) + len(visits)
+            if not save_patient_summary(db, patient, resp.choices[0].message.content, visits[-1]["id"],
+                                        len(visits), state["last_record_id"]):
+                # 其他任务已经更新过，重新读取后再合并
+                conflicts += 1
+                if conflicts > retries:
+                    raise RuntimeError(f"Longitudinal summary for {patient} kept changing; giving up")
 
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer)
-    styles = getSampleStyleSheet()
-    story = []
+def summarize_and_extract(text, info):
+    return "".join(stream_summary(text, info))
 
+def render_markdown(doctor, patient, date, session_id, transcript, summary):
     # Markdown文本部分（供网页显示）
-    markdown_text = f"""# This is the session #{session_id}
+    return f"""# This is the session #{session_id}
 
 **Doctor:** {doctor}  
 **Patient:** {patient}  
@@ -180,6 +309,24 @@ def generate_report(doctor, patient, date, session_id, transcript, summary):
 ## Summary & Possible Diagnoses
 {summary}
 """
+
+def generate_report(doctor, patient, date, session_id, transcript, summary):
+    # print(f"Generating Report: Doctor={doctor}, Patient={patient}, Date={date}, Session={session_id}")
+    with timed("stage", stage="report") as stats:
+        buffer, markdown_text = _build_report(doctor, patient, date, session_id, transcript, summary)
+        stats["bytes"] = buffer.getbuffer().nbytes
+    return buffer, markdown_text
+
+def _build_report(doctor, patient, date, session_id, transcript, summary):
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+    from reportlab.lib.styles import getSampleStyleSheet
+
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer)
+    styles = getSampleStyleSheet()
+    story = []
+    markdown_text = render_markdown(doctor, patient, date, session_id, transcript, summary)
+
     # 插入基本信息
     story.append(Paragraph(f"This is the session #{session_id}", styles['Title']))
     story.append(Spacer(1, 12))
@@ -202,8 +349,104 @@ def generate_report(doctor, patient, date, session_id, transcript, summary):
     return buffer, markdown_text
 
 
+# Background processing
+JOB_POLL_INTERVAL = 0.5
+
+def run_session_job(queue, job):
+    # 后台执行第三步：转录 -> 总结 -> 保存记录
+    # 每个阶段完成后把结果写入任务记录，重启后从未完成的阶段继续
+    payload, result = job["payload"], job["result"]
+    doc_name, pat_name, date_str = payload["doctor"], payload["patient"], payload["date"]
+
+    record_id = result.get("record_id")
+    if record_id is None:
+        transcript = result.get("transcript")
+        if transcript is None:
+            with queue.stage(job["id"], "transcribe"):
+                manual_text = payload["manual_text"]
+                transcript = manual_text if manual_text.strip() else transcribe_audio(payload["audio_path"], payload["file_path"])
+            queue.update_result(job["id"], transcript=transcript)
+
+        summary = result.get("summary")
+        if summary is None:
+            with queue.stage(job["id"], "summarize"):
+                info = f"Doctor: {doc_name}, Patient: {pat_name}, Date: {date_str}"
+                parts = []
+                queue.set_partial(job["id"], parts)
+                for delta in stream_summary(transcript, info):
+                    parts.append(delta)
+                summary = "".join(parts)
+            queue.update_result(job["id"], summary=summary)
+
+        with queue.stage(job["id"], "save"):
+            record_id, visit_number = insert_session(db, doc_name, pat_name, date_str, transcript, summary)
+        # 文本已保存到 history（转录压缩存储），任务记录中只保留记录 id，界面从 history 读取
+        queue.update_result(job["id"], record_id=record_id, visit_number=visit_number, drop=("transcript", "summary"))
+        # PDF 不在这里生成，用户点击下载时再由 report_store 按需生成
+
+    # 长期总结作为单独的任务更新，不拖慢本次报告
+    if not result.get("longitudinal_job"):
+        longitudinal_job = queue.submit("longitudinal", {"patient": normalize_name(pat_name)})
+        queue.update_result(job["id"], longitudinal_job=longitudinal_job)
+
+def run_longitudinal_job(queue, job):
+    with queue.stage(job["id"], "longitudinal"):
+        update_longitudinal_summary(job["payload"]["patient"])
+
+JOB_HANDLERS = {"session": run_session_job, "longitudinal": run_longitudinal_job}
+
+def run_job(queue, job):
+    JOB_HANDLERS[job["kind"]](queue, job)
+
+def render_timeline(patient, labels):
+    visits, longitudinal = fetch_patient_timeline(db, patient)
+    if not visits:
+        return labels["no_visits"]
+    lines = [f"# {patient}", f"## {labels['longitudinal']}", longitudinal["summary"] or "—"]
+    pending = sum(1 for v in visits if v["id"] > longitudinal["last_record_id"])
+    if pending:
+        lines.append(f"*{pending} {labels['longitudinal_pending']}*")
+    lines.append(f"## {labels['timeline']}")
+    for v in visits:
+        lines.append(f"### #{v['visit_number']} · {v['date']} · {v['doctor']}")
+        if v["diseases"]:
+            lines.append(f"**{labels['diagnoses']}:** {v['diseases']}")
+        lines.append(v["summary"] or "")
+    return "\n\n".join(lines)
+
+def setup(db_path=DB_PATH, archive_path=ARCHIVE_DB_PATH):
+    # 打开数据库并创建缓存、任务队列和报告存储；重复调用直接返回
+    global db, result_cache, job_queue, report_store
+    with _setup_lock:
+        if db is not None:
+            return
+        database = Database(db_path, archive_path=archive_path)
+        # 初始化数据库
+        if not init_database(database):
+            print("Failed to initialize database. The application may not work properly.")
+        result_cache = ResultCache(database)
+        job_queue = JobQueue(database, run_job)
+        report_store = ReportStore(lambda *fields: generate_report(*fields)[0])
+
+        # 抓取 /metrics 时才读取的状态
+        metrics.gauge("job_queue_jobs", job_queue.queue_depth)
+        metrics.gauge("result_cache", result_cache.stats)
+        metrics.gauge("report_store", lambda: {"hits": report_store.hits, "renders": report_store.renders})
+        metrics.gauge("db_connections", database.open_connections)
+        db = database
+
+def report_path(record_id):
+    record = get_session_record(db, record_id)
+    if record is None:
+        return None
+    return report_store.get(record_id, record["doctor"], record["patient"], record["date"],
+                            record["visit_number"], record["transcript"], record["summary"])
+
+
 # Build UI
 def build_ui():
+    import gradio as gr
+
     doctor_state = gr.State("")
     patient_state = gr.State("")
     date_state = gr.State("")
@@ -277,7 +520,11 @@ def build_ui():
         current_step = gr.State(0)
         transcript_state = gr.State("")
         summary_state = gr.State("")
-        pdf_path_state = gr.State("")
+        job_id_state = gr.State(None)
+        record_id_state = gr.State(None)
+        history_selected_state = gr.State(None)
+        history_page_state = gr.State({})
+        live_id_state = gr.State(None)
 
         # Progress bar
         progress_html = """
@@ -325,6 +572,8 @@ def build_ui():
 
                 with step2:
                     audio = gr.Audio(label="录制/上传音频", type='filepath')
+                    live_audio = gr.Audio(label="实时录音（边录边转录）", sources=["microphone"], type="numpy", streaming=True)
+                    live_transcript = gr.Textbox(label="实时转录", lines=6, interactive=False)
                     file_obj = gr.File(label="上传文件", file_types=[".pdf", ".txt", ".docx"])
                     text_input = gr.Textbox(label="手动输入文本 (可选)", lines=10)
                     next2 = gr.Button(value="下一步")
@@ -332,21 +581,43 @@ def build_ui():
                 with step3:
                     transcript_md = gr.Markdown(label="转录文本", value="", visible=True)
                     summary_md = gr.Markdown(label="总结", value="", visible=True)
-                    edit_btn = gr.Button(value="编辑总结")
+                    edit_btn = gr.Button(value="编辑总结", visible=False)   # 任务完成、有记录 id 后才显示
                     edited_summary = gr.Textbox(label="Edit Summary", lines=10, visible=False)
                     save_edit_btn = gr.Button(value="保存总结", visible=False)
+                    download_report_btn = gr.Button(value="下载报告", visible=False)
                     download_btn = gr.File(label="下载报告", visible=False)
+                    job_status = gr.Markdown("")
+                    job_timer = gr.Timer(JOB_POLL_INTERVAL, active=False)
 
                 with history_area:
+                    with gr.Row():
+                        history_search = gr.Textbox(label="搜索转录和总结", scale=4)
+                        history_search_btn = gr.Button(value="搜索", scale=1)
+                    with gr.Row():
+                        history_patient = gr.Textbox(label="按病人筛选")
+                        history_doctor = gr.Textbox(label="按医生筛选")
+                        history_date_from = gr.Textbox(label="开始日期", placeholder="YYYY-MM-DD")
+                        history_date_to = gr.Textbox(label="结束日期", placeholder="YYYY-MM-DD")
+                        history_diagnosis = gr.Textbox(label="按诊断筛选")
                     history_btn_view = gr.Button(value="刷新历史记录")
                     history_table = gr.Dataframe(
                         headers=["ID", "Visit", "Doctor", "Patient", "Date", "Transcript", "Summary"],
                         interactive=True,
                         visible=False
                     )
+                    with gr.Row():
+                        history_prev = gr.Button(value="上一页", interactive=False)
+                        history_page_info = gr.Markdown("")
+                        history_next = gr.Button(value="下一页", interactive=False)
                     history_transcript = gr.Textbox(label="Transcript", lines=10, visible=False)
                     history_summary = gr.Textbox(label="Summary", lines=10, visible=False)
+                    history_download_btn = gr.Button(value="下载报告", visible=False)
                     history_download = gr.File(label="Download Report", visible=False)
+                    with gr.Row():
+                        timeline_patient = gr.Textbox(label="病人时间线（输入病人姓名）", scale=4)
+                        timeline_btn = gr.Button(value="查看时间线", scale=1)
+                        timeline_refresh_btn = gr.Button(value="更新长期总结", scale=1)
+                    timeline_md = gr.Markdown("", visible=False)
 
         # Define UI interactions
         def switch_language(language):
@@ -364,7 +635,15 @@ def build_ui():
                    gr.update(value=labels["edit"]), gr.update(value=labels["save"]), \
                    gr.update(label=labels["download"]), gr.update(value=labels["new_chat"]), \
                    gr.update(value=labels["history"]), gr.update(value=labels["refresh"]), \
-                   gr.update(value=step_html)
+                   gr.update(value=step_html), gr.update(label=labels["filter_patient"]), \
+                   gr.update(label=labels["filter_doctor"]), gr.update(label=labels["date_from"]), \
+                   gr.update(label=labels["date_to"]), gr.update(label=labels["filter_diagnosis"]), \
+                   gr.update(value=labels["prev_page"]), \
+                   gr.update(value=labels["next_page"]), gr.update(label=labels["search"]), \
+                   gr.update(value=labels["search_btn"]), gr.update(value=labels["download"]), \
+                   gr.update(value=labels["download"]), gr.update(label=labels["live"]), \
+                   gr.update(label=labels["live_transcript"]), gr.update(label=labels["timeline_patient"]), \
+                   gr.update(value=labels["timeline_btn"]), gr.update(value=labels["timeline_refresh"])
 
         def update_progress(step):
             progress_html = f"""
@@ -375,137 +654,229 @@ def build_ui():
             return progress_html
 
         def go_step2(doc_name, pat_name, date_str, labels):
+            # 姓名按规范化后的形式传给后续步骤，保存、查询和长期总结都使用同一个写法
+            doc_name, pat_name, date_str = normalize_name(doc_name), normalize_name(pat_name), (date_str or "").strip()
             if not all([doc_name, pat_name, date_str]):
                 gr.Warning(labels["required"])
                 return gr.update(visible=True), gr.update(visible=False), gr.update(visible=False), gr.update(visible=False), 0, update_progress(0), "", "", ""
             return gr.update(visible=False), gr.update(visible=True), gr.update(visible=False), gr.update(visible=False), 1, update_progress(1), doc_name, pat_name, date_str
 
+        def live_start(live_id, request: gr.Request):
+            # 开始新的录音，丢弃上一次没有正常结束的会话以及其他页面遗留的空闲会话
+            discard_live_session(live_id)
+            evict_idle_live_sessions()
+            live_id = uuid.uuid4().hex
+            with _live_lock:
+                live_sessions[live_id] = LiveSession(transcribe_live_window)
+                if request is not None and request.session_hash:
+                    live_owners[request.session_hash] = live_id
+            return live_id, ""
+
+        def live_feed(chunk, live_id, labels):
+            session = live_sessions.get(live_id)
+            if chunk is None or session is None:
+                return gr.update()
+            evict_idle_live_sessions()
+            sample_rate, samples = chunk
+            session.feed(sample_rate, samples)
+            pending = session.pending()
+            text = session.transcript()
+            return f"{text}\n\n({pending} {labels['live_pending']})".strip() if pending else text
+
+        def live_stop(live_id, manual_text, labels):
+            # 停止录音后只需转录最后一个窗口；完整转录填入手动输入框，下一步直接使用，不再重新转录
+            session = pop_live_session(live_id)
+            if session is None:
+                return None, gr.update(), gr.update()
+            transcript = session.finish()
+            if session.failed:
+                # 失败的片段已重试过；其余片段照常使用，提示医生补充缺口
+                spans = ", ".join(f"{session.windows[i][0] // 1000}-{session.windows[i][1] // 1000}s" for i in session.failed)
+                gr.Warning(labels["live_gap"] + spans)
+            if manual_text.strip():
+                transcript = f"{manual_text.strip()}\n\n{transcript}"
+            return None, transcript, transcript
+
         def go_step3(audio_path, file_upload, manual_text, labels, doc_name, pat_name, date_str):
+            stay = (gr.update(visible=False), gr.update(visible=True), gr.update(visible=False), gr.update(visible=False), 1, update_progress(1), "", "", None, None, "", gr.update(active=False), gr.update(),
+                    gr.update(), gr.update(), gr.update(), gr.update())
             if not any([audio_path, file_upload, manual_text.strip()]):
                 gr.Warning(labels["input_required"])
-                return gr.update(visible=False), gr.update(visible=True), gr.update(visible=False), gr.update(visible=False), 1, update_progress(1), "", "", None
-            
-            progress = gr.Progress()
-            progress(0.2, desc=labels["processing"])
-            transcript = manual_text if manual_text.strip() else transcribe_audio(audio_path, file_upload)
-            progress(0.5, desc=labels["generating"])
-            info = f"Doctor: {doc_name}, Patient: {pat_name}, Date: {date_str}"
-            summary = summarize_and_extract(transcript, info)
-            progress(0.8, desc=labels["saving"])
-            
-            # 获取该病人的就诊次数
-            c.execute("SELECT MAX(visit_number) FROM history WHERE patient = ?", (pat_name,))
-            result = c.fetchone()
-            visit_number = (result[0] or 0) + 1  # 当前是第几次就诊
-            
-            # 插入新记录
-            c.execute("INSERT INTO history (visit_number, doctor, patient, date, transcript, summary, diseases) VALUES (?,?,?,?,?,?,?)",
-                      (visit_number, doc_name, pat_name, date_str, transcript, summary, ''))
-            conn.commit()
-            
-            # 获取刚插入记录的id
-            c.execute("SELECT id FROM history WHERE patient = ? AND visit_number = ?", (pat_name, visit_number))
-            record_id = c.fetchone()[0]
-            
-            progress(0.9, desc=labels["report"])
-            pdf_buffer, markdown_text = generate_report(doc_name, pat_name, date_str, visit_number, transcript, summary)
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-                tmp.write(pdf_buffer.read())
-                tmp_path = tmp.name
-            progress(1.0, desc=labels["complete"])
-            
+                return stay
+
+            # 提交后台任务后立即返回，由定时器轮询任务状态；
+            # 清除上一条记录的 id 并隐藏编辑按钮，新任务完成前不能编辑或保存到上一位病人的记录
+            file_path = file_upload if isinstance(file_upload, str) or file_upload is None else file_upload.name
+            try:
+                job_id = job_queue.submit(
+                    "session",
+                    {"doctor": doc_name, "patient": pat_name, "date": date_str, "manual_text": manual_text},
+                    files={"audio_path": audio_path, "file_path": file_path},
+                )
+            except OSError as e:
+                # 上传的临时文件已不存在等：任务已标记为失败，留在第二步重新上传
+                gr.Warning(labels["failed"] + str(e))
+                return stay
             return (
                 gr.update(visible=False), gr.update(visible=False), gr.update(visible=True),
                 gr.update(visible=False),
                 2, update_progress(2),
-                gr.update(value=transcript),   # 更新 transcript_md
-                gr.update(value=markdown_text),  # 更新 summary_md
-                tmp_path  # 给 download 按钮
+                gr.update(value=""), gr.update(value="", visible=True), gr.update(value=None, visible=False),
+                job_id, labels["queued"], gr.update(active=True), gr.update(visible=False),
+                None, gr.update(visible=False), gr.update(visible=False), gr.update(visible=False)
             )
-        def enter_edit(summary_content):
-            return gr.update(visible=False), gr.update(visible=False), gr.update(visible=True, value=summary_content), gr.update(visible=True)
-
-        def save_summary(edited_content, transcript, markdown_text, doc_name, pat_name, date_str):
-            info = "Edited Info"
-            # 获取该病人的最新就诊记录
-            c.execute("SELECT MAX(visit_number) FROM history WHERE patient = ?", (pat_name,))
-            result = c.fetchone()
-            visit_number = result[0] or 0
-            
-            pdf_buffer, markdown_text = generate_report(doc_name, pat_name, date_str, visit_number, transcript, edited_content)
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-                tmp.write(pdf_buffer.read())
-                tmp_path = tmp.name
-            return edited_content, gr.update(value=edited_content, visible=True), gr.update(visible=True), tmp_path
-
-        def load_history():
-            # 查询所有历史记录，按日期降序排列
-            c.execute("""
-                SELECT id, visit_number, doctor, patient, date, transcript, summary 
-                FROM history 
-                ORDER BY date DESC, visit_number DESC
-            """)
-            rows = c.fetchall()
-            
-            # 如果没有记录，返回空列表
-            if not rows:
-                return gr.update(
-                    value=[],
+
+        def poll_job(job_id, labels):
+            if job_id is None:
+                return gr.update(), gr.update(), gr.update(), "", gr.update(active=False), gr.update(), gr.update(), gr.update()
+            job = job_queue.get(job_id)
+            if job is None:
+                return gr.update(), gr.update(), gr.update(), "", gr.update(active=False), gr.update(), gr.update(), gr.update()
+            result = job["result"]
+            stage_desc = {
+                "queued": labels["queued"],
+                "transcribe": labels["processing"],
+                "summarize": labels["generating"],
+                "save": labels["saving"],
+                "done": labels["complete"],
+            }
+            if job["status"] == "failed":
+                gr.Warning(labels["failed"] + (job["error"] or ""))
+                return (gr.update(), gr.update(), gr.update(), labels["failed"] + (job["error"] or ""), gr.update(active=False),
+                        None, gr.update(visible=False), gr.update(visible=False))
+            if job["status"] == "done":
+                record = get_session_record(db, result["record_id"])
+                return (
+                    gr.update(value=record["transcript"]),   # 更新 transcript_md
+                    gr.update(value=render_markdown(record["doctor"], record["patient"], record["date"],
+                                                    record["visit_number"], record["transcript"], record["summary"])),  # 更新 summary_md
+                    gr.update(value=None, visible=False),
+                    labels["complete"],
+                    gr.update(active=False),
+                    result["record_id"],
+                    gr.update(visible=True),  # 显示下载按钮
+                    gr.update(visible=True)   # 显示编辑按钮
+                )
+            partial = job_queue.partial(job_id)
+            return (
+                gr.update(value=result["transcript"]) if "transcript" in result else gr.update(),
+                gr.update(value=partial) if partial is not None else gr.update(),
+                gr.update(),
+                stage_desc.get(job["stage"], labels["processing"]),
+                gr.update(), gr.update(), gr.update(), gr.update()
+            )
+
+        def enter_edit(record_id):
+            # 编辑框中只放当前记录的总结（而不是包含转录文本的整段 Markdown）
+            record = get_session_record(db, record_id) if record_id is not None else None
+            summary = record["summary"] if record else ""
+            return gr.update(visible=False), gr.update(visible=False), gr.update(visible=True, value=summary), gr.update(visible=True)
+
+        def save_summary(edited_content, record_id):
+            if record_id is None:
+                return gr.update(), gr.update(visible=True), gr.update(), gr.update(visible=True)
+            # 按记录 id 保存修订并更新当前总结；内容变化后下载时会重新生成 PDF
+            save_summary_revision(db, record_id, edited_content)
+            record = get_session_record(db, record_id)
+            markdown_text = render_markdown(record["doctor"], record["patient"], record["date"],
+                                            record["visit_number"], record["transcript"], record["summary"])
+            return markdown_text, gr.update(visible=True), gr.update(value=None, visible=False), gr.update(visible=False)
+
+        def prepare_download(record_id):
+            if record_id is None:
+                return gr.update(visible=False)
+            return gr.update(value=report_path(record_id), visible=True)
+
+        def load_history(pat_filter, doc_filter, date_from, date_to, diag_filter, page=None, direction="next"):
+            # 首次加载（或刷新）时 page 为空，从最新的记录开始
+            cursor = None
+            if page:
+                cursor = page["first"] if direction == "prev" else page["last"]
+            rows, new_page = fetch_history_page(
+                db, cursor, direction,
+                pat_filter.strip(), doc_filter.strip(), date_from.strip(), date_to.strip(),
+                diagnosis=diag_filter.strip()
+            )
+            new_page["number"] = (page.get("number", 1) + (-1 if direction == "prev" else 1)) if page else 1
+            return (
+                gr.update(
+                    value=rows,
                     headers=["ID", "Visit", "Doctor", "Patient", "Date", "Transcript", "Summary"],
                     visible=True
-                )
-            
-            # 格式化数据
-            formatted_rows = []
-            for row in rows:
-                # 截断过长的文本
-                transcript = row[5][:100] + "..." if len(row[5]) > 100 else row[5]
-                summary = row[6][:100] + "..." if len(row[6]) > 100 else row[6]
-                
-                formatted_rows.append([
-                    row[0],  # id
-                    row[1],  # visit_number
-                    row[2],  # doctor
-                    row[3],  # patient
-                    row[4],  # date
-                    transcript,
-                    summary
-                ])
-            
-            return gr.update(
-                value=formatted_rows,
-                headers=["ID", "Visit", "Doctor", "Patient", "Date", "Transcript", "Summary"],
-                visible=True
+                ),
+                new_page,
+                gr.update(interactive=new_page["has_prev"]),
+                gr.update(interactive=new_page["has_next"]),
+                f"**{new_page['number']}**",
             )
 
-        def view_history_details(evt: gr.SelectData):
-            if evt.index[0] is None:  # 如果没有选择行
-                return "", "", ""
+        def run_search(query):
+            if not query.strip():
+                return load_history("", "", "", "", "")
+            rows, page = search_history(db, query.strip())
+            page["number"] = 1
+            return (
+                gr.update(
+                    value=rows,
+                    headers=["ID", "Visit", "Doctor", "Patient", "Date", "Transcript", "Summary"],
+                    visible=True
+                ),
+                page,
+                gr.update(interactive=False),
+                gr.update(interactive=False),
+                f"**{len(rows)}**",
+            )
+
+        def load_prev_page(pat_filter, doc_filter, date_from, date_to, diag_filter, page):
+            return load_history(pat_filter, doc_filter, date_from, date_to, diag_filter, page, "prev")
+
+        def load_next_page(pat_filter, doc_filter, date_from, date_to, diag_filter, page):
+            return load_history(pat_filter, doc_filter, date_from, date_to, diag_filter, page, "next")
+
+        def view_history_details(page, evt: gr.SelectData):
+            if evt.index[0] is None or not page or evt.index[0] >= len(page["ids"]):  # 如果没有选择行
+                return "", "", gr.update(visible=False), gr.update(value=None, visible=False), None
             
             # 获取选中行的ID
-            selected_id = evt.value[evt.index[0]][0]
+            selected_id = page["ids"][evt.index[0]]
             
             # 查询完整记录
-            c.execute("""
-                SELECT transcript, summary 
-                FROM history 
-                WHERE id = ?
-            """, (selected_id,))
-            result = c.fetchone()
+            result = get_session(db, selected_id)
             
             if result:
-                return result[0], result[1], gr.update(visible=True)
-            return "", "", gr.update(visible=False)
+                return (gr.update(value=result[0], visible=True), gr.update(value=result[1], visible=True),
+                        gr.update(visible=True), gr.update(value=None, visible=False), selected_id)
+            return "", "", gr.update(visible=False), gr.update(value=None, visible=False), None
+
+        def view_timeline(patient, labels):
+            if not normalize_name(patient):
+                return gr.update(value="", visible=False)
+            return gr.update(value=render_timeline(normalize_name(patient), labels), visible=True)
+
+        def refresh_longitudinal(patient, labels):
+            if not normalize_name(patient):
+                return gr.update()
+            job_queue.submit("longitudinal", {"patient": normalize_name(patient)})
+            gr.Info(labels["longitudinal_queued"])
+            return gr.update()
 
         # Event bindings
         lang.change(fn=switch_language, inputs=[lang], 
                    outputs=[labels, doctor, patient, date, audio, file_obj, text_input, next1, next2,
                            transcript_md, summary_md, edit_btn, save_edit_btn, download_btn,
-                           new_chat_btn, history_btn, history_btn_view, step_indicator])
+                           new_chat_btn, history_btn, history_btn_view, step_indicator,
+                           history_patient, history_doctor, history_date_from, history_date_to, history_diagnosis,
+                           history_prev, history_next, history_search, history_search_btn,
+                           download_report_btn, history_download_btn, live_audio, live_transcript,
+                           timeline_patient, timeline_btn, timeline_refresh_btn])
 
         new_chat_btn.click(lambda: (gr.update(visible=True), gr.update(visible=False), gr.update(visible=False), 
-                                   gr.update(visible=False), 0, update_progress(0)), 
-                          outputs=[step1, step2, step3, history_area, current_step, progress])
+                                   gr.update(visible=False), 0, update_progress(0),
+                                   None, gr.update(visible=False), gr.update(visible=False), gr.update(visible=False),
+                                   gr.update(visible=False), gr.update(value=None, visible=False)), 
+                          outputs=[step1, step2, step3, history_area, current_step, progress,
+                                   record_id_state, edit_btn, edited_summary, save_edit_btn,
+                                   download_report_btn, download_btn])
         
         history_btn.click(lambda: (gr.update(visible=False), gr.update(visible=False), gr.update(visible=False), 
                                   gr.update(visible=True), 0, update_progress(0)), 
@@ -516,19 +887,56 @@ def build_ui():
             outputs=[step1, step2, step3, history_area, current_step, progress, doctor_state, patient_state, date_state]
         )
 
+        live_audio.start_recording(live_start, inputs=[live_id_state], outputs=[live_id_state, live_transcript])
+        live_audio.stream(live_feed, inputs=[live_audio, live_id_state, labels], outputs=[live_transcript],
+                          stream_every=1.0, concurrency_limit=None)
+        live_audio.stop_recording(live_stop, inputs=[live_id_state, text_input, labels],
+                                  outputs=[live_id_state, live_transcript, text_input])
+
+        def close_page(request: gr.Request):
+            # 页面关闭：丢弃该页面还在录音的会话
+            live_id = live_owners.get(request.session_hash) if request is not None else None
+            if live_id is not None:
+                discard_live_session(live_id)
+
+        demo.unload(close_page)
+
         next2.click(go_step3, inputs=[audio, file_obj, text_input, labels, doctor, patient, date], 
                    outputs=[step1, step2, step3, history_area, current_step, progress, 
-                           transcript_md, summary_md, download_btn])
-
-        edit_btn.click(enter_edit, inputs=[summary_md], outputs=[summary_md, summary_md, edited_summary, save_edit_btn])
-        save_edit_btn.click(save_summary, inputs=[edited_summary, transcript_md, summary_md, doctor, patient, date], outputs=[summary_md, summary_md, download_btn, pdf_path_state])
-        history_btn_view.click(load_history, inputs=[], outputs=[history_table])
+                           transcript_md, summary_md, download_btn, job_id_state, job_status, job_timer,
+                           download_report_btn, record_id_state, edit_btn, edited_summary, save_edit_btn])
+        job_timer.tick(poll_job, inputs=[job_id_state, labels],
+                       outputs=[transcript_md, summary_md, download_btn, job_status, job_timer,
+                                record_id_state, download_report_btn, edit_btn])
+
+        edit_btn.click(enter_edit, inputs=[record_id_state], outputs=[summary_md, summary_md, edited_summary, save_edit_btn])
+        save_edit_btn.click(save_summary, inputs=[edited_summary, record_id_state], outputs=[summary_md, summary_md, download_btn, save_edit_btn])
+        download_report_btn.click(prepare_download, inputs=[record_id_state], outputs=[download_btn])
+        history_filters = [history_patient, history_doctor, history_date_from, history_date_to, history_diagnosis]
+        history_outputs = [history_table, history_page_state, history_prev, history_next, history_page_info]
+        history_btn_view.click(load_history, inputs=history_filters, outputs=history_outputs)
+        history_search_btn.click(run_search, inputs=[history_search], outputs=history_outputs)
+        history_search.submit(run_search, inputs=[history_search], outputs=history_outputs)
+        history_prev.click(load_prev_page, inputs=history_filters + [history_page_state], outputs=history_outputs)
+        history_next.click(load_next_page, inputs=history_filters + [history_page_state], outputs=history_outputs)
         history_table.select(
             fn=view_history_details,
-            outputs=[history_transcript, history_summary, history_download]
+            inputs=[history_page_state],
+            outputs=[history_transcript, history_summary, history_download_btn, history_download, history_selected_state]
         )
+        timeline_btn.click(view_timeline, inputs=[timeline_patient, labels], outputs=[timeline_md])
+        timeline_patient.submit(view_timeline, inputs=[timeline_patient, labels], outputs=[timeline_md])
+        timeline_refresh_btn.click(refresh_longitudinal, inputs=[timeline_patient, labels], outputs=[timeline_md])
+        history_download_btn.click(prepare_download, inputs=[history_selected_state], outputs=[history_download])
 
     return demo
 
-app = build_ui()
-app.launch()
+def main():
+    setup()
+    metrics.start_server()
+    job_queue.start()
+    app = build_ui()
+    app.launch()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import argparse
+import os
+import sys
+from datetime import date, timedelta
+
+import app
+from db import archive_sessions, compact_database
+
+# Archive
+# 把旧就诊的转录全文和总结修订从 assistant.db 移到单独的归档库（archive.db），主库保持较小；
+# 历史列表、时间线和诊断查询照常显示这些就诊，打开记录时从归档库读取全文
+#
+# 用法：
+#   python archive.py --before 2023-01-01
+#   python archive.py --older-than 365 --vacuum
+
+
+def file_size(path):
+    # WAL 模式下尚未检查点的数据在 -wal 文件中
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move transcripts of old sessions into the archive database.")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--before", help="archive sessions dated before this day (YYYY-MM-DD)")
+    group.add_argument("--older-than", type=int, help="archive sessions older than this many days")
+    parser.add_argument("--db", default=app.DB_PATH, help="main database")
+    parser.add_argument("--archive", default=app.ARCHIVE_DB_PATH, help="archive database (created if missing)")
+    parser.add_argument("--batch-size", type=int, default=500, help="sessions moved per transaction")
+    parser.add_argument("--vacuum", action="store_true", help="compact the search index and shrink the main database file")
+    args = parser.parse_args(argv)
+
+    before = args.before or (date.today() - timedelta(days=args.older_than)).isoformat()
+    app.setup(args.db, args.archive)
+    size = file_size(args.db)
+    result = archive_sessions(app.db, before, args.batch_size)
+    if args.vacuum and result["sessions"]:
+        compact_database(app.db)
+    ratio = result["raw_bytes"] / result["stored_bytes"] if result["stored_bytes"] else 0
+    print(f"archived {result['sessions']} sessions dated before {before} to {args.archive} "
+          f"({result['raw_bytes'] / 1e6:.1f} MB of text, {result['stored_bytes'] / 1e6:.1f} MB compressed, {ratio:.1f}x)")
+    print(f"{args.db}: {size / 1e6:.1f} MB -> {file_size(args.db) / 1e6:.1f} MB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
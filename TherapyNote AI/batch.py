@@ -0,0 +1,204 @@
+import argparse
+import csv
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import app
+from app import transcribe_audio, summarize_and_extract, generate_report
+from db import insert_sessions
+import metrics
+
+# Batch import
+# 无界面批量处理历史录音/笔记：并发转录与总结（限制并发数和请求速率），
+# 每条处理结果都记录在 batch_items 表中，中断后使用相同的 run id 重新运行即可从断点继续；
+# 每批结果用一个事务写入 history 表
+#
+# 用法：
+#   python batch.py manifest.csv --run-id spring-import
+#   python batch.py recordings/ --doctor "Dr. Wang" --workers 4 --rate 30
+#
+# manifest.csv 需要包含 doctor, patient, date, file 四列（file 可以是相对于 manifest 的路径）；
+# 目录模式下文件名格式为 <patient>_<YYYY-MM-DD>.<ext>，不含日期时使用文件修改日期
+
+DOCUMENT_EXTENSIONS = (".txt", ".pdf", ".docx")
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".m4a", ".mp4", ".mpeg", ".mpga", ".webm", ".ogg", ".flac")
+
+
+class RateLimiter:
+    # 限制每分钟发起的处理数（每条至少包含一次总结 API 调用）
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute else 0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def init_batch_table(database):
+    with database.transaction() as conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS batch_items (
+            run_id TEXT,
+            item_key TEXT,
+            doctor TEXT,
+            patient TEXT,
+            date TEXT,
+            file TEXT,
+            status TEXT,
+            transcript TEXT,
+            summary TEXT,
+            record_id INTEGER,
+            error TEXT,
+            PRIMARY KEY (run_id, item_key)
+        )''')
+
+
+def read_manifest(path):
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            file_path = row["file"].strip()
+            if not os.path.isabs(file_path):
+                file_path = os.path.join(base, file_path)
+            yield {"doctor": row["doctor"].strip(), "patient": row["patient"].strip(),
+                   "date": row["date"].strip(), "file": file_path}
+
+
+def scan_directory(path, doctor):
+    for name in sorted(os.listdir(path)):
+        file_path = os.path.join(path, name)
+        stem, ext = os.path.splitext(name)
+        if not os.path.isfile(file_path) or ext.lower() not in DOCUMENT_EXTENSIONS + AUDIO_EXTENSIONS:
+            continue
+        patient, _, date = stem.rpartition("_")
+        try:
+            datetime.strptime(date, "%Y-%m-%d")
+        except ValueError:
+            patient = stem
+            date = str(datetime.fromtimestamp(os.path.getmtime(file_path)).date())
+        yield {"doctor": doctor, "patient": patient, "date": date, "file": file_path}
+
+
+def register_items(database, run_id, items):
+    # 已登记的条目保持原状态，这样重新运行时可以跳过已完成的部分
+    with database.transaction() as conn:
+        conn.executemany(
+            """INSERT OR IGNORE INTO batch_items (run_id, item_key, doctor, patient, date, file, status)
+               VALUES (?,?,?,?,?,?,'pending')""",
+            [(run_id, os.path.abspath(item["file"]), item["doctor"], item["patient"], item["date"], item["file"])
+             for item in items]
+        )
+
+
+def process_item(item, limiter):
+    limiter.wait()
+    if item["file"].lower().endswith(DOCUMENT_EXTENSIONS):
+        transcript = transcribe_audio(None, item["file"])
+    else:
+        transcript = transcribe_audio(item["file"], None)
+    info = f"Doctor: {item['doctor']}, Patient: {item['patient']}, Date: {item['date']}"
+    return transcript, summarize_and_extract(transcript, info)
+
+
+def save_batch(database, run_id, items, pdf_dir=None):
+    # 同一病人按日期排序后写入，保证就诊次数与就诊日期顺序一致
+    items = sorted(items, key=lambda item: (item["patient"], item["date"]))
+    with metrics.timed("db_write", op="insert_sessions") as stats, database.transaction() as conn:
+        stats["rows"] = len(items)
+        inserted = insert_sessions(conn, [
+            (item["doctor"], item["patient"], item["date"], item["transcript"], item["summary"]) for item in items
+        ])
+        conn.executemany(
+            # 写入 history 后清空暂存的文本
+            "UPDATE batch_items SET status = 'saved', record_id = ?, transcript = NULL, summary = NULL WHERE run_id = ? AND item_key = ?",
+            [(record_id, run_id, item["item_key"]) for item, (record_id, _) in zip(items, inserted)]
+        )
+    if pdf_dir:
+        os.makedirs(pdf_dir, exist_ok=True)
+        for item, (record_id, visit_number) in zip(items, inserted):
+            pdf_buffer, _ = generate_report(item["doctor"], item["patient"], item["date"], visit_number,
+                                            item["transcript"], item["summary"])
+            with open(os.path.join(pdf_dir, f"{record_id}.pdf"), "wb") as f:
+                f.write(pdf_buffer.getvalue())
+    return len(items)
+
+
+def run_batch(database, run_id, items, workers=4, rate_per_minute=60, batch_size=20, pdf_dir=None):
+    init_batch_table(database)
+    register_items(database, run_id, items)
+
+    columns = ("item_key", "doctor", "patient", "date", "file", "status", "transcript", "summary")
+    rows = [dict(zip(columns, row)) for row in database.execute(
+        f"SELECT {', '.join(columns)} FROM batch_items WHERE run_id = ? AND status != 'saved' ORDER BY rowid",
+        (run_id,)
+    ).fetchall()]
+    # 上次已处理完但还没写入 history 的条目直接进入待保存队列
+    ready = [row for row in rows if row["status"] == "processed"]
+    todo = [row for row in rows if row["status"] != "processed"]
+    print(f"[{run_id}] {len(todo)} to process, {len(ready)} ready to save")
+
+    saved = failed = 0
+    limiter = RateLimiter(rate_per_minute)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(process_item, row, limiter): row for row in todo}
+        for future in as_completed(futures):
+            row = futures[future]
+            try:
+                row["transcript"], row["summary"] = future.result()
+            except Exception as e:
+                failed += 1
+                database.execute(
+                    "UPDATE batch_items SET status = 'failed', error = ? WHERE run_id = ? AND item_key = ?",
+                    (str(e), run_id, row["item_key"])
+                )
+                print(f"[{run_id}] failed: {row['file']}: {e}", file=sys.stderr)
+                continue
+            database.execute(
+                "UPDATE batch_items SET status = 'processed', transcript = ?, summary = ?, error = NULL WHERE run_id = ? AND item_key = ?",
+                (row["transcript"], row["summary"], run_id, row["item_key"])
+            )
+            ready.append(row)
+            if len(ready) >= batch_size:
+                saved += save_batch(database, run_id, ready, pdf_dir)
+                ready = []
+                print(f"[{run_id}] saved {saved}")
+    if ready:
+        saved += save_batch(database, run_id, ready, pdf_dir)
+    print(f"[{run_id}] done: {saved} saved, {failed} failed")
+    return saved, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch-process session recordings and notes into the history table.")
+    parser.add_argument("source", help="manifest CSV (doctor, patient, date, file) or a directory of files")
+    parser.add_argument("--doctor", default="", help="doctor name for directory mode")
+    parser.add_argument("--run-id", help="checkpoint name; rerun with the same id to resume (default: source name)")
+    parser.add_argument("--workers", type=int, default=4, help="items processed concurrently")
+    parser.add_argument("--rate", type=float, default=60, help="max items started per minute (0 = unlimited)")
+    parser.add_argument("--batch-size", type=int, default=20, help="items written per transaction")
+    parser.add_argument("--pdf-dir", help="also write a PDF report per saved session to this directory")
+    args = parser.parse_args(argv)
+
+    if os.path.isdir(args.source):
+        items = list(scan_directory(args.source, args.doctor))
+    else:
+        items = list(read_manifest(args.source))
+    run_id = args.run_id or os.path.basename(os.path.normpath(args.source))
+    app.setup()
+    _, failed = run_batch(app.db, run_id, items, args.workers, args.rate, args.batch_size, args.pdf_dir)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,828 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+# Offline benchmarks
+# 使用本地的 OpenAI 替身（可配置延迟和返回长度），不需要 API key 即可测量：
+#   pipeline  第三步完整流程（提交任务 -> 转录/读取 -> 流式总结 -> 保存），分别测文本、文档、音频输入和缓存命中
+#   extract   合成 PDF / DOCX 的文本提取
+#   report    长转录文本的 generate_report
+#   history   10 万条记录下的 load_history 翻页、筛选、全文搜索和诊断查询
+#   startup   在新解释器中导入 app / batch 的耗时，超过 IMPORT_BUDGET 或导入了重依赖时视为失败
+#   gateway   真实 openai 客户端 + ApiGateway 访问本地 HTTP 假服务（按比例注入 429 / 5xx），统计成功率、重试和请求合并
+#   concurrency  多线程同时 insert_session，任何报错或某个病人的就诊次数不连续即为失败
+#   storage   旧版（转录内联在 history 中）与压缩存储、归档后的数据库大小和历史查询延迟对比，以及迁移耗时
+#
+# 用法：
+#   python bench.py --output bench-results.json
+#   python bench.py --only history --history-rows 100000
+#   python bench.py --compare bench-baseline.json --threshold 0.2
+#
+# 所有数据都写在临时目录中；结果为 JSON（每项包含 min/median/p95/max 秒数），
+# 使用 --compare 与之前的结果对比，中位数变慢超过阈值时返回非零退出码
+
+SUITES = ("startup", "pipeline", "extract", "report", "history", "gateway", "storage", "concurrency")
+
+# 导入耗时预算（秒）：工具和工作进程只导入这些模块，不应加载界面和 API 客户端
+IMPORT_BUDGET = {"app": 0.25, "batch": 0.25}
+HEAVY_MODULES = ("gradio", "openai", "reportlab", "PyPDF2", "docx", "pydub")
+
+IMPORT_PROBE = """
+import json, sys, time
+sys.path.insert(0, sys.argv[1])
+start = time.perf_counter()
+__import__(sys.argv[2])
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed, "heavy": [m for m in sys.argv[3:] if m in sys.modules]}))
+"""
+
+SUMMARY_TEMPLATE = """1. Chief Complaint: Persistent low mood and poor sleep for {weeks} weeks.
+2. History of Present Illness: {filler}
+3. Mental Status Examination: Alert, oriented, constricted affect, linear thought process.
+4. Assessment: Symptoms consistent with a depressive episode with anxious distress.
+5. Possible Diagnoses:
+- {diagnosis}
+- Generalized Anxiety Disorder
+6. Recommendations: Weekly CBT sessions; sleep hygiene education.
+7. Plan: Review medication options with psychiatry.
+8. Follow-Up: Return in two weeks.
+"""
+
+DIAGNOSES = ["Major Depressive Disorder", "Persistent Depressive Disorder", "Adjustment Disorder",
+             "Panic Disorder", "Insomnia Disorder", "Post-Traumatic Stress Disorder"]
+
+WORDS = ("patient reports feeling tired anxious sleep work family appetite mood energy worry "
+         "concentration therapy session week stress support medication improvement").split()
+
+
+def filler_text(chars, rng):
+    words = []
+    size = 0
+    while size < chars:
+        word = rng.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)[:chars]
+
+
+class FakeOpenAI:
+    # 与 OpenAI 客户端相同的调用方式：chat.completions.create / audio.transcriptions.create
+    # latency 为每次请求的固定延迟；流式输出每块之间再等待 chunk_delay
+    def __init__(self, latency=0.05, chunk_delay=0.002, summary_chars=3000, transcript_chars=5000,
+                 chunk_chars=20, seed=0):
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.summary_chars = summary_chars
+        self.transcript_chars = transcript_chars
+        self.chunk_chars = chunk_chars
+        self.rng = random.Random(seed)
+        self.calls = {"chat": 0, "chat_stream": 0, "transcription": 0}
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat))
+        self.audio = SimpleNamespace(transcriptions=SimpleNamespace(create=self._transcribe))
+
+    def _count(self, kind):
+        with self._lock:
+            self.calls[kind] += 1
+
+    def _summary(self, prompt):
+        filler = filler_text(max(self.summary_chars - len(SUMMARY_TEMPLATE) - 40, 0), self.rng)
+        return SUMMARY_TEMPLATE.format(weeks=len(prompt) % 12 + 1, filler=filler,
+                                       diagnosis=DIAGNOSES[len(prompt) % len(DIAGNOSES)])
+
+    def _usage(self, prompt, completion):
+        return SimpleNamespace(prompt_tokens=len(prompt) // 4, completion_tokens=len(completion) // 4)
+
+    def _chat(self, model, messages, stream=False, **kwargs):
+        prompt = messages[-1]["content"]
+        text = self._summary(prompt)
+        time.sleep(self.latency)
+        if not stream:
+            self._count("chat")
+            return SimpleNamespace(
+                choices=[SimpleNamespace(message=SimpleNamespace(content=text))],
+                usage=self._usage(prompt, text),
+            )
+        self._count("chat_stream")
+        return self._stream(prompt, text)
+
+    def _stream(self, prompt, text):
+        for i in range(0, len(text), self.chunk_chars):
+            if self.chunk_delay:
+                time.sleep(self.chunk_delay)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text[i:i + self.chunk_chars]))],
+                                  usage=None)
+        yield SimpleNamespace(choices=[], usage=self._usage(prompt, text))
+
+    def _transcribe(self, file, model, **kwargs):
+        self._count("transcription")
+        time.sleep(self.latency)
+        return SimpleNamespace(text=filler_text(self.transcript_chars, self.rng))
+
+
+class FakeOpenAIServer:
+    # 本地 HTTP 版 OpenAI 接口（chat 普通/流式、音频转录），按比例返回 429（带 Retry-After）和 500/503
+    def __init__(self, fake, error_429=0.2, error_5xx=0.1, retry_after=0.1, seed=0):
+        self.fake = fake
+        self.error_429 = error_429
+        self.error_5xx = error_5xx
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.counts = {"requests": 0, "429": 0, "5xx": 0}
+        self._lock = threading.Lock()
+        self.server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def _inject(self):
+        with self._lock:
+            self.counts["requests"] += 1
+            roll = self.rng.random()
+            if roll < self.error_429:
+                self.counts["429"] += 1
+                return 429
+            if roll < self.error_429 + self.error_5xx:
+                self.counts["5xx"] += 1
+                return self.rng.choice((500, 503))
+        return None
+
+    def start(self):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        owner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _json(self, status, body, headers=()):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                time.sleep(owner.fake.latency)
+                status = owner._inject()
+                if status == 429:
+                    return self._json(429, {"error": {"message": "Rate limit reached", "type": "requests"}},
+                                      [("retry-after", str(owner.retry_after))])
+                if status:
+                    return self._json(status, {"error": {"message": "Upstream error", "type": "server_error"}})
+                if self.path.endswith("/audio/transcriptions"):
+                    return self._json(200, {"text": filler_text(owner.fake.transcript_chars, owner.fake.rng)})
+                request = json.loads(body)
+                prompt = request["messages"][-1]["content"]
+                text = owner.fake._summary(prompt)
+                usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(text) // 4,
+                         "total_tokens": (len(prompt) + len(text)) // 4}
+                base = {"id": "chatcmpl-bench", "created": int(time.time()), "model": request["model"]}
+                if not request.get("stream"):
+                    return self._json(200, {**base, "object": "chat.completion", "usage": usage, "choices": [
+                        {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}]})
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                for i in range(0, len(text), owner.fake.chunk_chars):
+                    chunk = {**base, "object": "chat.completion.chunk", "choices": [
+                        {"index": 0, "delta": {"content": text[i:i + owner.fake.chunk_chars]}, "finish_reason": None}]}
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.write(f"data: {json.dumps({**base, 'object': 'chat.completion.chunk', 'choices': [], 'usage': usage})}\n\n".encode("utf-8"))
+                self.wfile.write(b"data: [DONE]\n\n")
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+
+def summarize_times(name, times, **params):
+    ordered = sorted(times)
+    return {
+        "name": name,
+        "params": params,
+        "repeat": len(times),
+        "min": ordered[0],
+        "median": statistics.median(ordered),
+        "p95": ordered[min(int(0.95 * len(ordered)), len(ordered) - 1)],
+        "max": ordered[-1],
+        "mean": statistics.fmean(ordered),
+    }
+
+
+def measure(name, fn, repeat, warmup=1, **params):
+    for i in range(warmup):
+        fn(i)
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn(warmup + i)
+        times.append(time.perf_counter() - start)
+    result = summarize_times(name, times, **params)
+    print(f"  {name:<32} median {result['median'] * 1000:9.2f} ms   p95 {result['p95'] * 1000:9.2f} ms", file=sys.stderr)
+    return result
+
+
+# Synthetic inputs
+def make_pdf(path, pages, chars_per_page=2500, seed=0):
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+    rng = random.Random(seed)
+    c = canvas.Canvas(path, pagesize=A4)
+    for _ in range(pages):
+        text = c.beginText(40, 800)
+        body = filler_text(chars_per_page, rng)
+        for start in range(0, len(body), 90):
+            text.textLine(body[start:start + 90])
+        c.drawText(text)
+        c.showPage()
+    c.save()
+
+
+def make_docx(path, paragraphs, chars_per_paragraph=400, seed=0):
+    import docx
+    rng = random.Random(seed)
+    doc = docx.Document()
+    for _ in range(paragraphs):
+        doc.add_paragraph(filler_text(chars_per_paragraph, rng))
+    doc.save(path)
+
+
+def make_wav(path, seconds, rate=16000):
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes(b"\0\0" * int(seconds * rate))
+
+
+def populate_history(database, rows, batch=5000, seed=0):
+    from db import insert_sessions
+    rng = random.Random(seed)
+    patients = [f"patient-{i:05d}" for i in range(max(rows // 20, 1))]
+    doctors = [f"Dr. {name}" for name in ("Wang", "Li", "Zhang", "Chen", "Liu", "Yang")]
+    start = time.perf_counter()
+    for offset in range(0, rows, batch):
+        sessions = []
+        for i in range(offset, min(offset + batch, rows)):
+            day = 1 + i % 28
+            month = 1 + (i // 28) % 12
+            year = 2015 + i // (28 * 12) % 10
+            diagnosis = DIAGNOSES[i % len(DIAGNOSES)]
+            summary = SUMMARY_TEMPLATE.format(weeks=i % 12 + 1, filler=filler_text(200, rng), diagnosis=diagnosis)
+            sessions.append((rng.choice(doctors), rng.choice(patients), f"{year}-{month:02d}-{day:02d}",
+                             filler_text(600, rng), summary))
+        with database.transaction() as conn:
+            insert_sessions(conn, sessions)
+    elapsed = time.perf_counter() - start
+    print(f"  generated {rows} history rows in {elapsed:.1f} s", file=sys.stderr)
+    return patients, doctors
+
+
+# Suites
+def bench_startup(app, fake, args, workdir):
+    results = []
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    for module, budget in IMPORT_BUDGET.items():
+        times, heavy = [], set()
+        for _ in range(args.repeat):
+            out = subprocess.run([sys.executable, "-c", IMPORT_PROBE, source_dir, module, *HEAVY_MODULES],
+                                 cwd=workdir, capture_output=True, text=True, check=True)
+            probe = json.loads(out.stdout.strip().splitlines()[-1])
+            times.append(probe["seconds"])
+            heavy.update(probe["heavy"])
+        result = summarize_times(f"startup.import_{module}", times, budget=budget)
+        result["heavy_modules"] = sorted(heavy)
+        result["within_budget"] = result["median"] <= budget and not heavy
+        print(f"  {result['name']:<32} median {result['median'] * 1000:9.2f} ms   budget {budget * 1000:.0f} ms"
+              f"{'' if result['within_budget'] else '   OVER BUDGET'}"
+              f"{'   loads ' + ', '.join(sorted(heavy)) if heavy else ''}", file=sys.stderr)
+        results.append(result)
+    return results
+
+
+def bench_pipeline(app, fake, args, workdir):
+    results = []
+    nonce = f"{time.time():.6f}"
+
+    def run_jobs(label, make_job, sessions):
+        # 同时提交 sessions 个任务，记录每个任务从提交到完成的时间和整体吞吐
+        latencies = []
+        start = time.perf_counter()
+        pending = {}
+        for i in range(sessions):
+            payload, files = make_job(i)
+            pending[app.job_queue.submit("session", payload, files=files)] = time.perf_counter()
+        while pending:
+            for job_id, submitted in list(pending.items()):
+                job = app.job_queue.get(job_id)
+                if job["status"] == "failed":
+                    raise RuntimeError(f"job {job_id} failed: {job['error']}")
+                if job["status"] == "done":
+                    latencies.append(time.perf_counter() - submitted)
+                    del pending[job_id]
+            time.sleep(0.005)
+        total = time.perf_counter() - start
+        result = summarize_times(f"pipeline.{label}", latencies, sessions=sessions, latency=fake.latency,
+                                 summary_chars=fake.summary_chars)
+        result["throughput_per_s"] = sessions / total
+        print(f"  {result['name']:<32} median {result['median'] * 1000:9.2f} ms   "
+              f"{result['throughput_per_s']:.1f} sessions/s", file=sys.stderr)
+        results.append(result)
+
+    def payload(i, manual_text=""):
+        return {"doctor": "Dr. Bench", "patient": f"bench-{nonce}-{i % 5}", "date": "2024-01-01",
+                "manual_text": manual_text}
+
+    transcript = filler_text(args.transcript_chars, random.Random(1))
+    run_jobs("manual_text", lambda i: (payload(i, f"{nonce} {i} {transcript}"), None), args.sessions)
+
+    note_paths = []
+    for i in range(args.sessions):
+        # 内容各不相同，避免命中缓存
+        path = os.path.join(workdir, f"note-{i}.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"{nonce} document {i} {transcript}")
+        note_paths.append(path)
+    run_jobs("document", lambda i: (payload(i), {"audio_path": None, "file_path": note_paths[i]}), args.sessions)
+
+    wav_paths = []
+    for i in range(args.sessions):
+        path = os.path.join(workdir, f"audio-{i}.wav")
+        make_wav(path, 5 + i * 0.01)
+        wav_paths.append(path)
+    run_jobs("audio", lambda i: (payload(i), {"audio_path": wav_paths[i], "file_path": None}), args.sessions)
+
+    # 相同输入再跑一遍：转录和总结都应命中缓存
+    run_jobs("audio_cached", lambda i: (payload(i), {"audio_path": wav_paths[i], "file_path": None}), args.sessions)
+    return results
+
+
+def bench_extract(app, fake, args, workdir):
+    from extract import extract_text
+    results = []
+    for pages in args.pdf_pages:
+        path = os.path.join(workdir, f"bench-{pages}.pdf")
+        make_pdf(path, pages)
+        results.append(measure(f"extract.pdf.{pages}p", lambda i: extract_text(path), args.repeat, pages=pages,
+                               bytes=os.path.getsize(path)))
+    for paragraphs in args.docx_paragraphs:
+        path = os.path.join(workdir, f"bench-{paragraphs}.docx")
+        make_docx(path, paragraphs)
+        results.append(measure(f"extract.docx.{paragraphs}para", lambda i: extract_text(path), args.repeat,
+                               paragraphs=paragraphs, bytes=os.path.getsize(path)))
+    return results
+
+
+def bench_report(app, fake, args, workdir):
+    results = []
+    rng = random.Random(2)
+    summary = SUMMARY_TEMPLATE.format(weeks=3, filler=filler_text(2000, rng), diagnosis=DIAGNOSES[0])
+    for chars in args.report_chars:
+        transcript = "\n".join(filler_text(300, rng) for _ in range(max(chars // 300, 1)))
+        results.append(measure(
+            f"report.{chars}chars",
+            lambda i: app.generate_report("Dr. Bench", "bench", "2024-01-01", 1, transcript, summary),
+            args.repeat, chars=chars
+        ))
+    return results
+
+
+def bench_history(app, fake, args, workdir):
+    results = []
+    existing = app.db.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+    if existing < args.history_rows:
+        patients, doctors = populate_history(app.db, args.history_rows - existing)
+    else:
+        patients = [row[0] for row in app.db.execute("SELECT DISTINCT patient FROM history LIMIT 100")]
+        doctors = [row[0] for row in app.db.execute("SELECT DISTINCT doctor FROM history LIMIT 10")]
+    app.db.execute("ANALYZE")
+
+    ui = app.build_ui()
+    handlers = {f.fn.__name__: f.fn for f in ui.fns.values()}
+    load_history, run_search = handlers["load_history"], handlers["run_search"]
+    rows = args.history_rows
+
+    results.append(measure("history.first_page", lambda i: load_history("", "", "", "", ""), args.repeat, rows=rows))
+
+    def walk(i, pages=10):
+        _, page, *_ = load_history("", "", "", "", "")
+        for _ in range(pages):
+            _, page, *_ = load_history("", "", "", "", "", page, "next")
+
+    results.append(measure("history.next_10_pages", walk, args.repeat, rows=rows, pages=10))
+    results.append(measure("history.filter_patient",
+                           lambda i: load_history(patients[i % len(patients)], "", "", "", ""), args.repeat, rows=rows))
+    results.append(measure("history.filter_doctor_dates",
+                           lambda i: load_history("", doctors[i % len(doctors)], "2018-01-01", "2018-12-31", ""),
+                           args.repeat, rows=rows))
+    results.append(measure("history.filter_diagnosis",
+                           lambda i: load_history("", "", "", "", DIAGNOSES[i % len(DIAGNOSES)]), args.repeat, rows=rows))
+    results.append(measure("history.search", lambda i: run_search(rng_word(i)), args.repeat, rows=rows))
+    # 少于 3 个字符的词走二元组索引
+    results.append(measure("history.search_short", lambda i: run_search(WORDS[i % len(WORDS)][:2]), args.repeat, rows=rows))
+    # 结构化小节和诊断表上的查询
+    from db import get_report_sections, patients_with_diagnosis, diagnosis_counts
+    record_ids = [row[0] for row in app.db.execute("SELECT id FROM history ORDER BY id DESC LIMIT 100")]
+    results.append(measure("history.report_sections", lambda i: get_report_sections(app.db, record_ids[i % len(record_ids)]),
+                           args.repeat, rows=rows))
+    results.append(measure("history.patients_with_diagnosis",
+                           lambda i: patients_with_diagnosis(app.db, DIAGNOSES[i % len(DIAGNOSES)]), args.repeat, rows=rows))
+    results.append(measure("history.diagnosis_counts", lambda i: diagnosis_counts(app.db), args.repeat, rows=rows))
+    return results
+
+
+def rng_word(i):
+    return f"{WORDS[i % len(WORDS)]} {WORDS[(i * 7 + 3) % len(WORDS)]}"
+
+
+# 旧版表结构和历史列表查询，用于生成迁移前的数据库并作为对比基线
+LEGACY_SCHEMA = """
+CREATE TABLE history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, visit_number INTEGER, doctor TEXT, patient TEXT, date TEXT,
+    transcript TEXT, summary TEXT, diseases TEXT, UNIQUE(patient, visit_number)
+);
+CREATE INDEX idx_history_date_visit ON history(date, visit_number);
+CREATE INDEX idx_history_doctor ON history(doctor);
+CREATE VIRTUAL TABLE history_fts USING fts5(transcript, summary, content='history', content_rowid='id', tokenize='trigram');
+"""
+LEGACY_PAGE_SQL = """
+    SELECT id, visit_number, doctor, patient, date, substr(transcript, 1, 101), substr(summary, 1, 101)
+    FROM history {where} ORDER BY date DESC, visit_number DESC, id DESC LIMIT 51
+"""
+
+
+def make_legacy_history(path, rows, transcript_chars, seed=0):
+    import sqlite3
+    rng = random.Random(seed)
+    patients = [f"patient-{i:05d}" for i in range(max(rows // 20, 1))]
+    doctors = [f"Dr. {name}" for name in ("Wang", "Li", "Zhang", "Chen", "Liu", "Yang")]
+    visits = {}
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.executescript(LEGACY_SCHEMA)
+    conn.execute("BEGIN")
+    for i in range(rows):
+        patient = rng.choice(patients)
+        visits[patient] = visits.get(patient, 0) + 1
+        diagnosis = DIAGNOSES[i % len(DIAGNOSES)]
+        summary = SUMMARY_TEMPLATE.format(weeks=i % 12 + 1, filler=filler_text(200, rng), diagnosis=diagnosis)
+        conn.execute(
+            "INSERT INTO history (visit_number, doctor, patient, date, transcript, summary, diseases) VALUES (?,?,?,?,?,?,?)",
+            (visits[patient], rng.choice(doctors), patient,
+             f"{2015 + i // (28 * 12) % 10}-{1 + (i // 28) % 12:02d}-{1 + i % 28:02d}",
+             filler_text(transcript_chars, rng), summary, f"{diagnosis.lower()}; generalized anxiety disorder")
+        )
+    conn.execute("INSERT INTO history_fts(history_fts) VALUES ('rebuild')")
+    conn.execute("COMMIT")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    return doctors
+
+
+def database_bytes(*paths):
+    return sum(os.path.getsize(p) for path in paths for p in (path, path + "-wal") if os.path.exists(p))
+
+
+def bench_storage(app, fake, args, workdir):
+    import sqlite3
+    from db import Database, init_database, fetch_history_page, get_session, archive_sessions, compact_database
+    results = []
+    rows = args.storage_rows
+    legacy_path = os.path.join(workdir, "storage-legacy.db")
+    path = os.path.join(workdir, "storage.db")
+    archive_path = os.path.join(workdir, "storage-archive.db")
+    for p in (legacy_path, path, archive_path):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(p + suffix):
+                os.remove(p + suffix)
+
+    start = time.perf_counter()
+    doctors = make_legacy_history(legacy_path, rows, args.transcript_chars)
+    print(f"  generated {rows} legacy history rows in {time.perf_counter() - start:.1f} s", file=sys.stderr)
+    shutil.copy(legacy_path, path)
+    ids = list(range(1, rows + 1, max(rows // 100, 1)))
+
+    def run(layout, page, filtered, scan, open_record, db_bytes):
+        params = dict(rows=rows, transcript_chars=args.transcript_chars, db_bytes=db_bytes)
+        print(f"  {layout}: {db_bytes / 1e6:.1f} MB", file=sys.stderr)
+        results.append(measure(f"storage.{layout}.first_page", lambda i: page(), args.repeat, **params))
+        results.append(measure(f"storage.{layout}.filter_doctor_dates", lambda i: filtered(doctors[i % len(doctors)]),
+                               args.repeat, **params))
+        # 按 diseases 过滤需要扫描整张 history 表
+        results.append(measure(f"storage.{layout}.scan_diseases", lambda i: scan(DIAGNOSES[i % len(DIAGNOSES)]),
+                               args.repeat, **params))
+        results.append(measure(f"storage.{layout}.open_record", lambda i: open_record(ids[i % len(ids)]),
+                               args.repeat, **params))
+
+    legacy = sqlite3.connect(legacy_path)
+    scan_sql = "SELECT COUNT(*) FROM history WHERE diseases LIKE ?"
+    run("legacy",
+        lambda: legacy.execute(LEGACY_PAGE_SQL.format(where="")).fetchall(),
+        lambda doctor: legacy.execute(LEGACY_PAGE_SQL.format(where="WHERE doctor = ? AND date >= ? AND date <= ?"),
+                                      (doctor, "2018-01-01", "2018-12-31")).fetchall(),
+        lambda diagnosis: legacy.execute(scan_sql, (f"%{diagnosis.lower()}%",)).fetchone(),
+        lambda record_id: legacy.execute("SELECT transcript, summary FROM history WHERE id = ?", (record_id,)).fetchone(),
+        database_bytes(legacy_path))
+    legacy.close()
+
+    # 迁移（含 report_sections 回填、全文索引重建和 VACUUM）
+    database = Database(path, archive_path=archive_path)
+    start = time.perf_counter()
+    init_database(database)
+    database.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    migrate = summarize_times("storage.migrate", [time.perf_counter() - start], rows=rows,
+                              transcript_chars=args.transcript_chars)
+    print(f"  {migrate['name']:<32} {migrate['median']:9.2f} s", file=sys.stderr)
+    results.append(migrate)
+
+    def run_current(layout, db_bytes):
+        run(layout,
+            lambda: fetch_history_page(database),
+            lambda doctor: fetch_history_page(database, doctor=doctor, date_from="2018-01-01", date_to="2018-12-31"),
+            lambda diagnosis: database.execute(scan_sql, (f"%{diagnosis.lower()}%",)).fetchone(),
+            lambda record_id: get_session(database, record_id),
+            db_bytes)
+
+    run_current("compressed", database_bytes(path))
+
+    # 归档约一半的记录（2020 年之前），再打开的记录有一半需要读取归档库
+    start = time.perf_counter()
+    archived = archive_sessions(database, "2020-01-01")
+    compact_database(database)
+    result = summarize_times("storage.archive", [time.perf_counter() - start], rows=rows, **archived)
+    print(f"  {result['name']:<32} {result['median']:9.2f} s   ({archived['sessions']} sessions)", file=sys.stderr)
+    results.append(result)
+    run_current("archived", database_bytes(path))
+    print(f"  archive file: {database_bytes(archive_path) / 1e6:.1f} MB", file=sys.stderr)
+    database.close()
+    return results
+
+
+def bench_concurrency(app, fake, args, workdir):
+    # 每个线程连续写入 --concurrency-inserts 条记录，病人数较少，保证同一病人的就诊次数分配存在竞争
+    from db import Database, init_database, insert_session
+    path = os.path.join(workdir, "concurrency.db")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    database = Database(path)
+    init_database(database)
+    threads, inserts = args.concurrency_threads, args.concurrency_inserts
+    patients = [f"patient-{i}" for i in range(max(threads // 3, 1))]
+    barrier = threading.Barrier(threads)
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def writer(n):
+        rng = random.Random(n)
+        barrier.wait()
+        for i in range(inserts):
+            start = time.perf_counter()
+            try:
+                insert_session(database, "Dr. Bench", rng.choice(patients), "2024-01-01",
+                               filler_text(2000, rng), SUMMARY_TEMPLATE.format(weeks=1, filler="", diagnosis=DIAGNOSES[0]))
+            except Exception as e:
+                with lock:
+                    errors.append(f"{type(e).__name__}: {e}")
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=writer, args=(n,)) for n in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    # 每个病人的就诊次数必须是 1..n 且没有重复或空缺
+    gaps = [patient for patient, count, low, high in database.execute(
+        "SELECT patient, COUNT(*), MIN(visit_number), MAX(visit_number) FROM history GROUP BY patient"
+    ) if not (low == 1 and high == count)]
+    rows = database.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+    database.close()
+
+    result = summarize_times("concurrency.insert_session", latencies or [0.0], threads=threads, inserts=inserts)
+    result.update(errors=len(errors), rows=rows, non_contiguous_patients=len(gaps),
+                  throughput_per_s=rows / elapsed if elapsed else 0.0)
+    result["passed"] = not errors and not gaps and rows == threads * inserts
+    print(f"  {result['name']:<32} median {result['median'] * 1000:9.2f} ms   p95 {result['p95'] * 1000:9.2f} ms   "
+          f"{result['throughput_per_s']:.0f} inserts/s   {len(errors)} errors, {len(gaps)} patients with gaps"
+          f"{'' if result['passed'] else '   FAILED'}", file=sys.stderr)
+    for error in sorted(set(errors))[:5]:
+        print(f"    {error}", file=sys.stderr)
+    return [result]
+
+
+def bench_gateway(app, fake, args, workdir):
+    from openai import OpenAI
+    from gateway import ApiGateway, TokenBucket
+
+    results = []
+    server = FakeOpenAIServer(fake, args.error_429, args.error_5xx).start()
+    client = OpenAI(api_key="bench", base_url=server.url, max_retries=0)
+    try:
+        def run(label, gateway, make_request, requests, workers=16):
+            # 并发发送请求，记录每个请求（含重试）的耗时，以及上游实际收到的请求数
+            before = dict(server.counts)
+            latencies, failures = [], 0
+
+            def one(i):
+                start = time.perf_counter()
+                make_request(gateway, i)
+                return time.perf_counter() - start
+
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for future in [pool.submit(one, i) for i in range(requests)]:
+                    try:
+                        latencies.append(future.result())
+                    except Exception:
+                        failures += 1
+            result = summarize_times(f"gateway.{label}", latencies or [0.0], requests=requests,
+                                     error_429=args.error_429, error_5xx=args.error_5xx)
+            result.update(failed=failures, **{f"upstream_{k}": server.counts[k] - before[k] for k in server.counts},
+                          **{k: v for k, v in gateway.stats().items() if k in ("retries", "throttled", "deduplicated")})
+            print(f"  {result['name']:<32} median {result['median'] * 1000:9.2f} ms   {failures} failed, "
+                  f"{result['upstream_requests']} upstream, {result['retries']} retries, "
+                  f"{result['deduplicated']} deduplicated", file=sys.stderr)
+            results.append(result)
+
+        def chat(gateway, i):
+            gateway.chat.completions.create(model="gpt-4o", messages=[{"role": "user", "content": f"request {i}"}])
+
+        def chat_stream(gateway, i):
+            stream = gateway.chat.completions.create(model="gpt-4o", stream=True,
+                                                     messages=[{"role": "user", "content": f"stream {i}"}])
+            "".join(c.choices[0].delta.content or "" for c in stream if c.choices)
+
+        def chat_same(gateway, i):
+            gateway.chat.completions.create(model="gpt-4o", messages=[{"role": "user", "content": "identical"}])
+
+        def transcribe(gateway, i):
+            gateway.audio.transcriptions.create(file=(f"chunk_{i}.wav", b"RIFF" + bytes(4000)), model="whisper-1")
+
+        def make_gateway():
+            return ApiGateway(client, chat_rpm=0, chat_tpm=0, audio_rpm=0, backoff=0.05, max_backoff=1.0)
+
+        run("chat_with_errors", make_gateway(), chat, args.gateway_requests)
+        run("stream_with_errors", make_gateway(), chat_stream, args.gateway_requests)
+        run("identical_concurrent", make_gateway(), chat_same, args.gateway_requests)
+        run("identical_audio", make_gateway(), transcribe, args.gateway_requests)
+
+        # 限流：每分钟 600 次、突发 60 次时，请求会被均匀地推迟
+        limited = make_gateway()
+        limited.buckets["chat"] = [TokenBucket(600, burst=60)]
+        run("chat_rate_limited", limited, chat, args.gateway_requests)
+    finally:
+        server.stop()
+    return results
+
+
+BENCHMARKS = {"startup": bench_startup, "pipeline": bench_pipeline, "extract": bench_extract, "report": bench_report, "history": bench_history,
+              "gateway": bench_gateway, "storage": bench_storage, "concurrency": bench_concurrency}
+
+
+def metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, timeout=5,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ""
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare(results, baseline_path, threshold):
+    # 中位数比基线慢 threshold 以上视为退化
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {r["name"]: r for r in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        old = baseline.get(result["name"])
+        if not old or not old["median"]:
+            continue
+        ratio = result["median"] / old["median"]
+        flag = "REGRESSION" if ratio > 1 + threshold else ""
+        print(f"  {result['name']:<32} {old['median'] * 1000:9.2f} -> {result['median'] * 1000:9.2f} ms "
+              f"({ratio:5.2f}x) {flag}", file=sys.stderr)
+        if flag:
+            regressions.append(result["name"])
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run offline benchmarks against a fake OpenAI backend.")
+    parser.add_argument("--only", default=",".join(SUITES), help=f"comma-separated suites ({', '.join(SUITES)})")
+    parser.add_argument("--output", help="write JSON results to this file (default: stdout)")
+    parser.add_argument("--compare", help="baseline JSON to compare medians against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown before a regression is reported")
+    parser.add_argument("--repeat", type=int, default=5, help="iterations per micro-benchmark")
+    parser.add_argument("--sessions", type=int, default=20, help="jobs submitted per pipeline benchmark")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake API latency per request (seconds)")
+    parser.add_argument("--chunk-delay", type=float, default=0.002, help="fake delay between streamed chunks")
+    parser.add_argument("--summary-chars", type=int, default=3000, help="length of fake summaries")
+    parser.add_argument("--transcript-chars", type=int, default=5000, help="length of fake transcripts")
+    parser.add_argument("--pdf-pages", type=int, nargs="+", default=[10, 200], help="synthetic PDF sizes")
+    parser.add_argument("--docx-paragraphs", type=int, nargs="+", default=[100, 2000], help="synthetic DOCX sizes")
+    parser.add_argument("--report-chars", type=int, nargs="+", default=[20000, 200000], help="transcript lengths for reports")
+    parser.add_argument("--history-rows", type=int, default=100000, help="rows in the generated history table")
+    parser.add_argument("--storage-rows", type=int, default=20000, help="rows in the storage migration benchmark")
+    parser.add_argument("--concurrency-threads", type=int, default=24, help="threads inserting sessions at once")
+    parser.add_argument("--concurrency-inserts", type=int, default=40, help="sessions inserted per thread")
+    parser.add_argument("--gateway-requests", type=int, default=100, help="requests per gateway benchmark")
+    parser.add_argument("--error-429", type=float, default=0.2, help="share of fake server responses that are 429")
+    parser.add_argument("--error-5xx", type=float, default=0.1, help="share of fake server responses that are 500/503")
+    parser.add_argument("--workdir", help="reuse this directory (keeps the generated database between runs)")
+    args = parser.parse_args(argv)
+
+    suites = [s.strip() for s in args.only.split(",") if s.strip()]
+    unknown = set(suites) - set(SUITES)
+    if unknown:
+        parser.error(f"unknown suite: {', '.join(sorted(unknown))}")
+
+    # app.setup() 在当前目录打开 assistant.db，因此先切换到临时目录
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="therapynote-bench-"))
+    os.makedirs(workdir, exist_ok=True)
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.compare) if args.compare else None
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+    import app
+    app.setup()
+    fake = FakeOpenAI(args.latency, args.chunk_delay, args.summary_chars, args.transcript_chars)
+    app.client = fake
+    # 流水线等基准不测限流（限流由 gateway 套件单独测量），只保留重试和请求合并
+    from gateway import ApiGateway
+    app.gateway = ApiGateway(fake, chat_rpm=0, chat_tpm=0, audio_rpm=0)
+    if "pipeline" in suites:
+        app.job_queue.start()
+
+    results = []
+    try:
+        for suite in suites:
+            print(f"[{suite}]", file=sys.stderr)
+            results.extend(BENCHMARKS[suite](app, fake, args, workdir))
+    finally:
+        app.job_queue.stop(timeout=5)
+        if not args.workdir:
+            os.chdir(os.path.dirname(workdir))
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {"meta": {**metadata(), "suites": suites, "fake_api_calls": fake.calls,
+                       "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")}},
+              "results": results}
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    status = 0
+    over_budget = [r["name"] for r in results if r.get("within_budget") is False]
+    if over_budget:
+        print(f"over budget: {', '.join(over_budget)}", file=sys.stderr)
+        status = 1
+    failed = [r["name"] for r in results if r.get("passed") is False]
+    if failed:
+        print(f"failed: {', '.join(failed)}", file=sys.stderr)
+        status = 1
+    if baseline:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}", file=sys.stderr)
+            status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
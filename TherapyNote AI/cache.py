@@ -0,0 +1,105 @@
+import hashlib
+import os
+import threading
+import time
+
+# Content-addressed result cache
+# 以 输入内容哈希 + 模型 + 提示词版本 作为键，缓存转录和总结结果，避免重复调用 API
+
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", 200 * 1024 * 1024))
+CACHE_MAX_AGE = float(os.getenv("CACHE_MAX_AGE_DAYS", 30)) * 24 * 3600
+
+
+def content_key(kind, model, version, data=None, path=None):
+    h = hashlib.sha256()
+    h.update(f"{kind}\0{model}\0{version}\0".encode("utf-8"))
+    if path is not None:
+        # 大文件分块读取，避免一次性读入内存
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(block)
+    elif isinstance(data, str):
+        h.update(data.encode("utf-8"))
+    elif data is not None:
+        h.update(data)
+    return h.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, database, max_bytes=CACHE_MAX_BYTES, max_age=CACHE_MAX_AGE):
+        self.db = database
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        with self.db.transaction() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS result_cache (
+                key TEXT PRIMARY KEY,
+                kind TEXT,
+                value TEXT,
+                size INTEGER,
+                created_at REAL,
+                accessed_at REAL,
+                hits INTEGER DEFAULT 0
+            )''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_result_cache_accessed ON result_cache(accessed_at)")
+
+    def get(self, key):
+        now = time.time()
+        row = self.db.execute(
+            "SELECT value, created_at FROM result_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or now - row[1] > self.max_age:
+            with self._lock:
+                self.misses += 1
+            return None
+        self.db.execute(
+            "UPDATE result_cache SET accessed_at = ?, hits = hits + 1 WHERE key = ?", (now, key)
+        )
+        with self._lock:
+            self.hits += 1
+        return row[0]
+
+    def put(self, key, kind, value):
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self.db.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO result_cache (key, kind, value, size, created_at, accessed_at) VALUES (?,?,?,?,?,?)",
+                (key, kind, value, size, now, now)
+            )
+            evicted = self._evict(conn, now)
+        with self._lock:
+            self.evictions += evicted
+
+    def get_or_compute(self, key, kind, compute):
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, kind, value)
+        return value
+
+    def _evict(self, conn, now):
+        # 先按时间淘汰过期条目，再按最近访问时间淘汰到总大小以内
+        evicted = conn.execute("DELETE FROM result_cache WHERE created_at < ?", (now - self.max_age,)).rowcount
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM result_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return evicted
+        for key, size in conn.execute(
+            "SELECT key, size FROM result_cache ORDER BY accessed_at"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM result_cache WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+        return evicted
+
+    def stats(self):
+        entries, size = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM result_cache"
+        ).fetchone()
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": entries, "bytes": size}
@@ -0,0 +1,793 @@
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import weakref
+import zlib
+from contextlib import contextmanager
+
+from metrics import timed
+from sections import SECTION_KEYS, parse_sections, parse_diagnoses, normalize_diagnosis
+
+# Data access layer
+# 每个线程使用自己的连接（WAL 模式下读写互不阻塞），写操作使用显式事务
+
+BUSY_TIMEOUT_MS = 5000
+INSERT_RETRIES = 5
+RETRY_BACKOFF = 0.05
+COMPRESSION_LEVEL = 6
+SCHEMA_VERSION = 1           # PRAGMA user_version：1 = 诊断名称按新规则（逗号后的限定词不单独成条）重新规范化
+
+
+def compress_text(text):
+    # 转录文本以 zlib 压缩的 UTF-8 存储
+    return zlib.compress((text or "").encode("utf-8"), COMPRESSION_LEVEL)
+
+
+def decompress_text(data):
+    return None if data is None else zlib.decompress(data).decode("utf-8")
+
+
+_CJK_RE = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+")
+
+
+def _bigrams(run):
+    # 每个字与下一个字组成一个词，连续汉字的最后一个字单独成词；
+    # 任意单字都是某个词的前缀，任意两字都是一个完整的词
+    return " " + " ".join([run[i:i + 2] for i in range(len(run) - 1)] + [run[-1]]) + " "
+
+
+def cjk_bigrams(text):
+    # 供 history_bigrams 索引的文本：连续的中日韩文字切成二元组，其他文字保持原样交给 unicode61 分词
+    if text is None:
+        return None
+    return _CJK_RE.sub(lambda m: _bigrams(m.group(0)), text)
+
+
+class _ThreadConnection:
+    # 线程结束时 threading.local 中的对象被释放，由 finalizer 关闭该线程的连接；
+    # Database 只保留弱引用，短命线程（gradio 工作线程、metrics 请求线程）不会留下打开的连接
+    def __init__(self, conn):
+        self.conn = conn
+        self.close = weakref.finalize(self, conn.close)
+
+
+class Database:
+    def __init__(self, path, busy_timeout_ms=BUSY_TIMEOUT_MS, archive_path=None):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self.archive_path = archive_path
+        self._local = threading.local()
+        self._connections = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    def connection(self):
+        holder = getattr(self._local, "holder", None)
+        if holder is None:
+            # isolation_level=None：不使用隐式事务，由 transaction() 显式控制
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute("PRAGMA temp_store = MEMORY")
+            # 全文索引通过 history_text 视图读取转录原文时需要解压，二元组索引的文本由 cjk_bigrams 生成
+            conn.create_function("decompress_text", 1, decompress_text, deterministic=True)
+            conn.create_function("cjk_bigrams", 1, cjk_bigrams, deterministic=True)
+            holder = _ThreadConnection(conn)
+            self._local.holder = holder
+            with self._lock:
+                self._connections.add(holder)
+        return holder.conn
+
+    def execute(self, sql, params=()):
+        return self.connection().execute(sql, params)
+
+    def attach_archive(self, create=False):
+        # 归档库按需 ATTACH 到当前线程的连接上（必须在事务外调用）；没有归档库时返回 None
+        conn = self.connection()
+        if getattr(self._local, "archive", False):
+            return conn
+        if not self.archive_path or not (create or os.path.exists(self.archive_path)):
+            return None
+        conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+        self._local.archive = True
+        return conn
+
+    @contextmanager
+    def transaction(self, immediate=True):
+        # BEGIN IMMEDIATE 在事务开始时就获取写锁，避免读后写时的死锁/升级失败
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+    def open_connections(self):
+        return len(self._connections)
+
+    def close(self):
+        with self._lock:
+            holders = list(self._connections)
+            self._connections = weakref.WeakSet()
+        for holder in holders:
+            holder.close()
+        self._local = threading.local()
+
+
+def init_database(database):
+    try:
+        # 确保数据库目录存在
+        db_dir = os.path.dirname(database.path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+
+        with database.transaction() as conn:
+            # 创建表
+            conn.execute('''CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                visit_number INTEGER,
+                doctor TEXT,
+                patient TEXT,
+                date TEXT,
+                transcript_preview TEXT,
+                summary TEXT,
+                diseases TEXT,
+                UNIQUE(patient, visit_number)
+            )''')
+
+            # 历史记录分页与筛选所需的索引
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_history_date_visit ON history(date, visit_number)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_history_doctor ON history(doctor)")
+
+            # 转录全文单独存放并压缩，history 只保留列表预览，扫描 history 时不再读取大段文本；
+            # 归档后的记录在这里没有对应行，全文在归档库中
+            conn.execute('''CREATE TABLE IF NOT EXISTS transcripts (
+                record_id INTEGER PRIMARY KEY REFERENCES history(id),
+                size INTEGER,
+                data BLOB
+            )''')
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(history)")]
+            migrated = "transcript" in columns
+            if migrated:
+                # 迁移：旧版数据库的转录文本内联在 history.transcript 中
+                migrate_transcripts(conn)
+
+            # 全文检索索引（trigram 分词，中英文子串都能命中），内容通过视图从压缩的转录读取
+            fts_exists = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'history_fts'"
+            ).fetchone() is not None
+            # 少于 3 个字符的词（如“抑郁”“焦虑”）trigram 无法匹配，另建一个按汉字二元组切分的索引
+            bigrams_exist = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'history_bigrams'"
+            ).fetchone() is not None
+            if not bigrams_exist:
+                # 迁移：旧触发器只维护 history_fts，删除后按下面的定义重建
+                for trigger in ("transcripts_fts_ai", "transcripts_fts_ad", "history_fts_ad", "history_fts_au"):
+                    conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+            conn.execute('''CREATE VIEW IF NOT EXISTS history_text AS
+                SELECT h.id AS id, decompress_text(t.data) AS transcript, h.summary AS summary
+                FROM history h LEFT JOIN transcripts t ON t.record_id = h.id''')
+            conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+                transcript,
+                summary,
+                content='history_text',
+                content_rowid='id',
+                tokenize='trigram'
+            )''')
+            # 无内容表，只存索引；写入和删除时传入 cjk_bigrams() 处理后的文本
+            conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS history_bigrams USING fts5(
+                transcript,
+                summary,
+                content='',
+                tokenize='unicode61'
+            )''')
+            # 写入顺序是先 history 后 transcripts，索引在转录写入时建立；
+            # 删除转录（归档）时该记录只保留总结的索引
+            conn.execute('''CREATE TRIGGER IF NOT EXISTS transcripts_fts_ai AFTER INSERT ON transcripts BEGIN
+                INSERT INTO history_fts(rowid, transcript, summary)
+                    SELECT new.record_id, decompress_text(new.data), summary FROM history WHERE id = new.record_id;
+                INSERT INTO history_bigrams(rowid, transcript, summary)
+                    SELECT new.record_id, cjk_bigrams(decompress_text(new.data)), cjk_bigrams(summary)
+                    FROM history WHERE id = new.record_id;
+            END''')
+            conn.execute('''CREATE TRIGGER IF NOT EXISTS transcripts_fts_ad AFTER DELETE ON transcripts BEGIN
+                INSERT INTO history_fts(history_fts, rowid, transcript, summary)
+                    SELECT 'delete', old.record_id, decompress_text(old.data), summary FROM history WHERE id = old.record_id;
+                INSERT INTO history_fts(rowid, transcript, summary)
+                    SELECT old.record_id, NULL, summary FROM history WHERE id = old.record_id;
+                INSERT INTO history_bigrams(history_bigrams, rowid, transcript, summary)
+                    SELECT 'delete', old.record_id, cjk_bigrams(decompress_text(old.data)), cjk_bigrams(summary)
+                    FROM history WHERE id = old.record_id;
+                INSERT INTO history_bigrams(rowid, transcript, summary)
+                    SELECT old.record_id, NULL, cjk_bigrams(summary) FROM history WHERE id = old.record_id;
+            END''')
+            conn.execute('''CREATE TRIGGER IF NOT EXISTS history_fts_ad AFTER DELETE ON history BEGIN
+                INSERT INTO history_fts(history_fts, rowid, transcript, summary) VALUES ('delete', old.id,
+                    decompress_text((SELECT data FROM transcripts WHERE record_id = old.id)), old.summary);
+                INSERT INTO history_bigrams(history_bigrams, rowid, transcript, summary) VALUES ('delete', old.id,
+                    cjk_bigrams(decompress_text((SELECT data FROM transcripts WHERE record_id = old.id))),
+                    cjk_bigrams(old.summary));
+            END''')
+            conn.execute('''CREATE TRIGGER IF NOT EXISTS history_fts_au AFTER UPDATE OF summary ON history BEGIN
+                INSERT INTO history_fts(history_fts, rowid, transcript, summary) VALUES ('delete', old.id,
+                    decompress_text((SELECT data FROM transcripts WHERE record_id = old.id)), old.summary);
+                INSERT INTO history_fts(rowid, transcript, summary) VALUES (new.id,
+                    decompress_text((SELECT data FROM transcripts WHERE record_id = new.id)), new.summary);
+                INSERT INTO history_bigrams(history_bigrams, rowid, transcript, summary) VALUES ('delete', old.id,
+                    cjk_bigrams(decompress_text((SELECT data FROM transcripts WHERE record_id = old.id))),
+                    cjk_bigrams(old.summary));
+                INSERT INTO history_bigrams(rowid, transcript, summary) VALUES (new.id,
+                    cjk_bigrams(decompress_text((SELECT data FROM transcripts WHERE record_id = new.id))),
+                    cjk_bigrams(new.summary));
+            END''')
+            if not fts_exists:
+                # 迁移：为已有记录建立索引
+                conn.execute("INSERT INTO history_fts(history_fts) VALUES ('rebuild')")
+            if not bigrams_exist:
+                conn.execute('''INSERT INTO history_bigrams(rowid, transcript, summary)
+                    SELECT id, cjk_bigrams(transcript), cjk_bigrams(summary) FROM history_text''')
+
+            # 总结修订记录：保存被编辑覆盖之前的版本，history.summary 始终是最新版本
+            conn.execute('''CREATE TABLE IF NOT EXISTS summary_revisions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                record_id INTEGER NOT NULL REFERENCES history(id),
+                revision INTEGER NOT NULL,
+                summary TEXT,
+                created_at TEXT,
+                UNIQUE(record_id, revision)
+            )''')
+
+            # 结构化的报告小节与规范化诊断，用于按诊断查询
+            sections_exist = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'report_sections'"
+            ).fetchone() is not None
+            conn.execute(f'''CREATE TABLE IF NOT EXISTS report_sections (
+                record_id INTEGER PRIMARY KEY REFERENCES history(id),
+                {", ".join(f"{key} TEXT" for key in SECTION_KEYS)}
+            )''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS diagnoses (
+                record_id INTEGER NOT NULL REFERENCES history(id),
+                name TEXT NOT NULL,
+                label TEXT,
+                PRIMARY KEY (record_id, name)
+            )''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_diagnoses_name ON diagnoses(name, record_id)")
+            if not sections_exist:
+                # 迁移：解析已有记录的总结
+                backfill_report_sections(conn)
+            elif conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+                # 迁移：早期版本把单行诊断按逗号拆开，限定词（"recurrent"、"moderate"）被存成了单独的诊断
+                renormalize_diagnoses(conn)
+
+            # 每个病人的长期总结：只记录已计入的最后一条就诊，新就诊增量合并
+            conn.execute('''CREATE TABLE IF NOT EXISTS patient_summaries (
+                patient TEXT PRIMARY KEY,
+                summary TEXT,
+                last_record_id INTEGER NOT NULL DEFAULT 0,
+                visit_count INTEGER NOT NULL DEFAULT 0,
+                updated_at TEXT
+            )''')
+
+            # 迁移：早期版本按输入原样保存姓名（可能带首尾空格）
+            normalize_names(conn)
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        if migrated:
+            # 移出的文本所占的页只有 VACUUM 后才会还给文件系统
+            database.connection().execute("VACUUM")
+        return True
+    except sqlite3.NotSupportedError:
+        raise
+    except Exception as e:
+        print(f"Error initializing database: {e}")
+        return False
+
+
+INSERT_SESSION_SQL = """INSERT INTO history (visit_number, doctor, patient, date, transcript_preview, summary, diseases)
+    SELECT COALESCE(MAX(visit_number), 0) + 1, ?, ?, ?, ?, ?, ?
+    FROM history WHERE patient = ?
+    RETURNING id, visit_number"""
+
+
+def store_report_sections(conn, record_id, summary):
+    # 在调用方的事务中写入小节和诊断，返回用于 history.diseases 的诊断名称串
+    sections = parse_sections(summary)
+    diagnoses = parse_diagnoses(sections["possible_diagnoses"])
+    conn.execute(
+        f"INSERT OR REPLACE INTO report_sections (record_id, {', '.join(SECTION_KEYS)}) "
+        f"VALUES ({', '.join('?' * (len(SECTION_KEYS) + 1))})",
+        [record_id] + [sections[key] for key in SECTION_KEYS]
+    )
+    conn.execute("DELETE FROM diagnoses WHERE record_id = ?", (record_id,))
+    conn.executemany(
+        "INSERT INTO diagnoses (record_id, name, label) VALUES (?,?,?)",
+        [(record_id, name, label) for name, label in diagnoses]
+    )
+    return "; ".join(name for name, _ in diagnoses)
+
+
+def backfill_report_sections(conn, batch_size=500):
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            "SELECT id, summary FROM history WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            return
+        for record_id, summary in rows:
+            diseases = store_report_sections(conn, record_id, summary)
+            conn.execute("UPDATE history SET diseases = ? WHERE id = ?", (diseases, record_id))
+        last_id = rows[-1][0]
+
+
+def renormalize_diagnoses(conn, batch_size=500):
+    # 从已保存的“可能的诊断”小节重新提取诊断，只改写结果有变化的记录
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            "SELECT record_id, possible_diagnoses FROM report_sections WHERE record_id > ? ORDER BY record_id LIMIT ?",
+            (last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            return
+        for record_id, text in rows:
+            diagnoses = parse_diagnoses(text)
+            old = conn.execute("SELECT name, label FROM diagnoses WHERE record_id = ?", (record_id,)).fetchall()
+            if sorted(old) == sorted(diagnoses):
+                continue
+            conn.execute("DELETE FROM diagnoses WHERE record_id = ?", (record_id,))
+            conn.executemany("INSERT INTO diagnoses (record_id, name, label) VALUES (?,?,?)",
+                             [(record_id, name, label) for name, label in diagnoses])
+            conn.execute("UPDATE history SET diseases = ? WHERE id = ?",
+                         ("; ".join(name for name, _ in diagnoses), record_id))
+        last_id = rows[-1][0]
+
+
+def normalize_name(name):
+    # 医生/病人姓名去掉首尾空白后再保存和查询，避免 "Li " 与 "Li" 被当成两个人
+    return (name or "").strip()
+
+
+def normalize_names(conn):
+    # DISTINCT 走 idx_history_doctor 和 UNIQUE(patient, visit_number) 索引，已规范化的库只需两次索引扫描
+    for doctor, in conn.execute("SELECT DISTINCT doctor FROM history").fetchall():
+        if doctor is not None and normalize_name(doctor) != doctor:
+            conn.execute("UPDATE history SET doctor = ? WHERE doctor = ?", (normalize_name(doctor), doctor))
+
+    groups = {}
+    for patient, in conn.execute("SELECT DISTINCT patient FROM history").fetchall():
+        if patient is not None:
+            groups.setdefault(normalize_name(patient), []).append(patient)
+    for name, spellings in groups.items():
+        if spellings == [name]:
+            continue
+        marks = ", ".join("?" * len(spellings))
+        if len(spellings) == 1:
+            conn.execute("UPDATE history SET patient = ? WHERE patient = ?", (name, spellings[0]))
+            conn.execute("UPDATE OR IGNORE patient_summaries SET patient = ? WHERE patient = ?", (name, spellings[0]))
+            continue
+        # 几种写法合并为同一病人：按就诊日期重新编号（先改为负数避免唯一约束冲突），长期总结删除后由下一次更新重建
+        ids = [row[0] for row in conn.execute(
+            f"SELECT id FROM history WHERE patient IN ({marks}) ORDER BY date, visit_number, id", spellings
+        )]
+        conn.execute(f"UPDATE history SET visit_number = -id, patient = ? WHERE patient IN ({marks})", [name] + spellings)
+        conn.executemany("UPDATE history SET visit_number = ? WHERE id = ?",
+                         [(number, record_id) for number, record_id in enumerate(ids, 1)])
+        conn.execute(f"DELETE FROM patient_summaries WHERE patient IN ({marks})", spellings)
+
+
+def migrate_transcripts(conn, batch_size=500):
+    # 旧表结构：转录文本压缩后移入 transcripts，history 只留预览，然后删除 transcript 列。
+    # 旧的全文索引和触发器引用了该列，先删除，之后按新结构重建
+    if sqlite3.sqlite_version_info < (3, 35, 0):
+        # DROP COLUMN 需要 SQLite 3.35+；不能在旧表结构上继续运行（之后每次写入都会失败）
+        raise sqlite3.NotSupportedError(
+            f"SQLite {sqlite3.sqlite_version} cannot migrate {conn.execute('PRAGMA database_list').fetchone()[2]}: "
+            "version 3.35 or newer is required"
+        )
+    for trigger in ("history_fts_ai", "history_fts_ad", "history_fts_au"):
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    conn.execute("DROP TABLE IF EXISTS history_fts")
+    conn.execute("ALTER TABLE history ADD COLUMN transcript_preview TEXT")
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            "SELECT id, transcript FROM history WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        for record_id, transcript in rows:
+            transcript = transcript or ""
+            conn.execute("INSERT OR REPLACE INTO transcripts (record_id, size, data) VALUES (?, ?, ?)",
+                         (record_id, len(transcript.encode("utf-8")), compress_text(transcript)))
+            conn.execute("UPDATE history SET transcript_preview = ? WHERE id = ?",
+                         (transcript[:PREVIEW_CHARS + 1], record_id))
+        last_id = rows[-1][0]
+    conn.execute("ALTER TABLE history DROP COLUMN transcript")
+
+
+def _insert_session_row(conn, doctor, patient, date, transcript, summary):
+    doctor, patient = normalize_name(doctor), normalize_name(patient)
+    transcript = transcript or ""
+    record_id, visit_number = conn.execute(
+        INSERT_SESSION_SQL, (doctor, patient, date, transcript[:PREVIEW_CHARS + 1], summary, "", patient)
+    ).fetchone()
+    conn.execute("INSERT INTO transcripts (record_id, size, data) VALUES (?, ?, ?)",
+                 (record_id, len(transcript.encode("utf-8")), compress_text(transcript)))
+    # 总结只解析一次：小节和诊断写入后再回填 diseases
+    diseases = store_report_sections(conn, record_id, summary)
+    if diseases:
+        conn.execute("UPDATE history SET diseases = ? WHERE id = ?", (diseases, record_id))
+    return record_id, visit_number
+
+
+def insert_session(database, doctor, patient, date, transcript, summary, retries=INSERT_RETRIES):
+    # 就诊次数在同一条 INSERT ... SELECT 中分配（MAX 查询走 UNIQUE(patient, visit_number) 的索引），
+    # 并在 BEGIN IMMEDIATE 事务内执行，同一病人的并发保存不会拿到相同的次数；
+    # 遇到锁超时或唯一约束冲突时有限次重试
+    with timed("db_write", op="insert_session") as stats:
+        stats["bytes"] = len(transcript.encode("utf-8")) + len(summary.encode("utf-8"))
+        for attempt in range(retries + 1):
+            try:
+                with database.transaction() as conn:
+                    return _insert_session_row(conn, doctor, patient, date, transcript, summary)
+            except (sqlite3.IntegrityError, sqlite3.OperationalError):
+                if attempt == retries:
+                    raise
+                stats["retries"] = attempt + 1
+                time.sleep(RETRY_BACKOFF * (2 ** attempt) * (0.5 + random.random()))
+
+
+def insert_sessions(conn, sessions):
+    # 在调用方的事务中批量写入，sessions 为 (doctor, patient, date, transcript, summary) 列表
+    return [
+        _insert_session_row(conn, doctor, patient, date, transcript, summary)
+        for doctor, patient, date, transcript, summary in sessions
+    ]
+
+
+def save_summary_revision(database, record_id, summary):
+    # 一个事务内完成：旧版本写入 summary_revisions，再更新 history 中的当前总结；
+    # 已归档记录的早期修订在归档库中，修订号接着两边的最大值编号
+    latest = "COALESCE((SELECT MAX(revision) FROM summary_revisions WHERE record_id = h.id), 0)"
+    if database.attach_archive() is not None:
+        latest = f"MAX({latest}, COALESCE((SELECT MAX(revision) FROM archive.summary_revisions WHERE record_id = h.id), 0))"
+    with timed("db_write", op="save_summary_revision"), database.transaction() as conn:
+        conn.execute(
+            f"""INSERT INTO summary_revisions (record_id, revision, summary, created_at)
+               SELECT h.id, {latest} + 1, h.summary, datetime('now')
+               FROM history h WHERE h.id = ?""",
+            (record_id,)
+        )
+        diseases = store_report_sections(conn, record_id, summary)
+        conn.execute("UPDATE history SET summary = ?, diseases = ? WHERE id = ?", (summary, diseases, record_id))
+
+
+def get_summary_revisions(database, record_id):
+    sql = "SELECT revision, summary, created_at FROM summary_revisions WHERE record_id = ?"
+    params = [record_id]
+    if database.attach_archive() is not None:
+        sql += " UNION ALL SELECT revision, summary, created_at FROM archive.summary_revisions WHERE record_id = ?"
+        params.append(record_id)
+    return database.execute(sql + " ORDER BY revision", params).fetchall()
+
+
+def get_report_sections(database, record_id):
+    row = database.execute(
+        f"SELECT {', '.join(SECTION_KEYS)} FROM report_sections WHERE record_id = ?", (record_id,)
+    ).fetchone()
+    return dict(zip(SECTION_KEYS, row)) if row else None
+
+
+def patients_with_diagnosis(database, name):
+    # 按规范化诊断名称查询病人及最近一次出现该诊断的就诊
+    return database.execute(
+        """SELECT h.patient, COUNT(*), MAX(h.date)
+           FROM diagnoses d JOIN history h ON h.id = d.record_id
+           WHERE d.name = ?
+           GROUP BY h.patient
+           ORDER BY MAX(h.date) DESC""",
+        (normalize_diagnosis(name),)
+    ).fetchall()
+
+
+def diagnosis_counts(database, limit=50):
+    return database.execute(
+        "SELECT name, COUNT(DISTINCT record_id) FROM diagnoses GROUP BY name ORDER BY COUNT(DISTINCT record_id) DESC LIMIT ?",
+        (limit,)
+    ).fetchall()
+
+
+def get_transcript(database, record_id):
+    # 只在打开记录时解压全文；已归档的记录从归档库读取，归档库不可用时返回空文本
+    row = database.execute("SELECT data FROM transcripts WHERE record_id = ?", (record_id,)).fetchone()
+    if row is None:
+        conn = database.attach_archive()
+        row = conn and conn.execute("SELECT data FROM archive.transcripts WHERE record_id = ?", (record_id,)).fetchone()
+    return decompress_text(row[0]) if row else ""
+
+
+def get_session_record(database, record_id):
+    row = database.execute(
+        "SELECT id, visit_number, doctor, patient, date, summary FROM history WHERE id = ?", (record_id,)
+    ).fetchone()
+    if row is None:
+        return None
+    record = dict(zip(("id", "visit_number", "doctor", "patient", "date", "summary"), row))
+    record["transcript"] = get_transcript(database, record_id)
+    return record
+
+
+def get_session(database, record_id):
+    row = database.execute("SELECT summary FROM history WHERE id = ?", (record_id,)).fetchone()
+    if row is None:
+        return None
+    return get_transcript(database, record_id), row[0]
+
+
+# Patient timeline
+TIMELINE_COLUMNS = ("id", "visit_number", "date", "doctor", "diseases", "summary")
+
+def fetch_patient_timeline(database, patient):
+    # 一次按 UNIQUE(patient, visit_number) 索引读取该病人的全部就诊，加上已保存的长期总结
+    patient = normalize_name(patient)
+    conn = database.connection()
+    conn.execute("BEGIN")
+    try:
+        visits = [dict(zip(TIMELINE_COLUMNS, row)) for row in conn.execute(
+            f"SELECT {', '.join(TIMELINE_COLUMNS)} FROM history WHERE patient = ? ORDER BY visit_number", (patient,)
+        )]
+        longitudinal = get_patient_summary(conn, patient)
+    finally:
+        conn.execute("COMMIT")
+    return visits, longitudinal
+
+
+def get_patient_summary(database, patient):
+    # database 可以是 Database，也可以是事务中的连接
+    row = database.execute(
+        "SELECT summary, last_record_id, visit_count, updated_at FROM patient_summaries WHERE patient = ?", (patient,)
+    ).fetchone()
+    if row is None:
+        return {"summary": "", "last_record_id": 0, "visit_count": 0, "updated_at": None}
+    return dict(zip(("summary", "last_record_id", "visit_count", "updated_at"), row))
+
+
+def fetch_visits_after(database, patient, after_id, limit):
+    # 还没有计入长期总结的就诊（按写入顺序）
+    return [dict(zip(TIMELINE_COLUMNS, row)) for row in database.execute(
+        f"SELECT {', '.join(TIMELINE_COLUMNS)} FROM history WHERE patient = ? AND id > ? ORDER BY id LIMIT ?",
+        (patient, after_id, limit)
+    )]
+
+
+def save_patient_summary(database, patient, summary, last_record_id, added_visits, expected_last_id):
+    # 只有在长期总结没有被其他任务更新过（last_record_id 未变）时才写入，返回是否成功
+    with database.transaction() as conn:
+        current = conn.execute(
+            "SELECT last_record_id FROM patient_summaries WHERE patient = ?", (patient,)
+        ).fetchone()
+        if (current[0] if current else 0) != expected_last_id:
+            return False
+        conn.execute(
+            """INSERT INTO patient_summaries (patient, summary, last_record_id, visit_count, updated_at)
+               VALUES (?, ?, ?, ?, datetime('now'))
+               ON CONFLICT(patient) DO UPDATE SET summary = excluded.summary,
+                   last_record_id = excluded.last_record_id,
+                   visit_count = patient_summaries.visit_count + excluded.visit_count,
+                   updated_at = excluded.updated_at""",
+            (patient, summary, last_record_id, added_visits)
+        )
+        return True
+
+
+# History queries
+HISTORY_PAGE_SIZE = 50
+PREVIEW_CHARS = 100
+
+def fetch_history_page(database, cursor=None, direction="next", patient="", doctor="", date_from="", date_to="",
+                       page_size=HISTORY_PAGE_SIZE, diagnosis=""):
+    # 按 (date, visit_number, id) 做 keyset 分页，只读取预览长度的文本
+    # cursor 为当前页第一行（向前翻）或最后一行（向后翻）的 (date, visit_number, id)
+    patient, doctor = normalize_name(patient), normalize_name(doctor)
+    where, params = [], []
+    if patient:
+        where.append("patient = ?")
+        params.append(patient)
+    if doctor:
+        where.append("doctor = ?")
+        params.append(doctor)
+    if date_from:
+        where.append("date >= ?")
+        params.append(date_from)
+    if date_to:
+        where.append("date <= ?")
+        params.append(date_to)
+    if diagnosis:
+        where.append("id IN (SELECT record_id FROM diagnoses WHERE name = ?)")
+        params.append(normalize_diagnosis(diagnosis))
+
+    backwards = cursor is not None and direction == "prev"
+    if cursor is not None:
+        where.append("(date, visit_number, id) > (?, ?, ?)" if backwards else "(date, visit_number, id) < (?, ?, ?)")
+        params.extend(cursor)
+    order = "ASC" if backwards else "DESC"
+
+    sql = f"""
+        SELECT id, visit_number, doctor, patient, date,
+               transcript_preview, substr(summary, 1, {PREVIEW_CHARS + 1})
+        FROM history
+        {"WHERE " + " AND ".join(where) if where else ""}
+        ORDER BY date {order}, visit_number {order}, id {order}
+        LIMIT ?
+    """
+    rows = database.connection().execute(sql, params + [page_size + 1]).fetchall()
+
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backwards:
+        rows.reverse()
+
+    formatted_rows = []
+    for row in rows:
+        # 截断过长的文本
+        transcript = row[5] or ""
+        summary = row[6] or ""
+        formatted_rows.append([
+            row[0], row[1], row[2], row[3], row[4],
+            transcript[:PREVIEW_CHARS] + "..." if len(transcript) > PREVIEW_CHARS else transcript,
+            summary[:PREVIEW_CHARS] + "..." if len(summary) > PREVIEW_CHARS else summary,
+        ])
+
+    page = {
+        "first": (rows[0][4], rows[0][1], rows[0][0]) if rows else None,
+        "last": (rows[-1][4], rows[-1][1], rows[-1][0]) if rows else None,
+        # 往回翻时“更多”指更新的记录；往后翻时指更旧的记录
+        "has_prev": (has_more if backwards else cursor is not None),
+        "has_next": (cursor is not None if backwards else has_more),
+        "ids": [row[0] for row in rows],
+    }
+    return formatted_rows, page
+
+def search_history(database, query, limit=HISTORY_PAGE_SIZE):
+    # 3 个字符以上的词走 trigram 索引（子串匹配）；更短的词（常见的两字中文词、缩写）走二元组索引，
+    # 汉字按子串匹配，其他文字按词前缀匹配
+    terms = query.split()
+    phrases = [t for t in terms if len(t) >= 3]
+    short_terms = [t for t in terms if len(t) < 3]
+    if not terms:
+        return [], {"first": None, "last": None, "has_prev": False, "has_next": False, "ids": []}
+
+    where, params = [], []
+    if phrases:
+        where.append("history_fts MATCH ?")
+        params.append(" ".join('"' + t.replace('"', '""') + '"' for t in phrases))
+        source = "history_fts JOIN history h ON h.id = history_fts.rowid"
+    if short_terms:
+        bigram_query = " ".join('"' + t.replace('"', '""') + '"*' for t in short_terms)
+        if phrases:
+            where.append("h.id IN (SELECT rowid FROM history_bigrams WHERE history_bigrams MATCH ?)")
+        else:
+            where.append("history_bigrams MATCH ?")
+            source = "history_bigrams JOIN history h ON h.id = history_bigrams.rowid"
+        params.append(bigram_query)
+
+    order = "bm25(history_fts)" if phrases else "h.date DESC, h.visit_number DESC"
+    conn = database.connection()
+    # 先只按索引排序取出前 limit 条，再为这些记录生成摘要片段，避免解压所有命中记录的转录
+    ids = [row[0] for row in conn.execute(f"""
+        SELECT h.id
+        FROM {source}
+        WHERE {" AND ".join(where)}
+        ORDER BY {order}
+        LIMIT ?
+    """, params + [limit])]
+    if not ids:
+        return [], {"first": None, "last": None, "has_prev": False, "has_next": False, "ids": []}
+
+    marks = ", ".join("?" * len(ids))
+    if phrases:
+        rows = conn.execute(f"""
+            SELECT h.id, h.visit_number, h.doctor, h.patient, h.date,
+                   snippet(history_fts, 0, '【', '】', '...', 16), snippet(history_fts, 1, '【', '】', '...', 16)
+            FROM history_fts
+            JOIN history h ON h.id = history_fts.rowid
+            WHERE history_fts MATCH ? AND history_fts.rowid IN ({marks})
+        """, [params[0]] + ids).fetchall()
+    else:
+        rows = conn.execute(f"""
+            SELECT id, visit_number, doctor, patient, date,
+                   substr(transcript_preview, 1, {PREVIEW_CHARS}), substr(summary, 1, {PREVIEW_CHARS})
+            FROM history WHERE id IN ({marks})
+        """, ids).fetchall()
+    position = {record_id: i for i, record_id in enumerate(ids)}
+    rows.sort(key=lambda row: position[row[0]])
+
+    page = {"first": None, "last": None, "has_prev": False, "has_next": False, "ids": [row[0] for row in rows]}
+    return [list(row) for row in rows], page
+
+
+# Archive
+ARCHIVE_BATCH = 500
+ARCHIVE_HISTORY_COLUMNS = "id, visit_number, doctor, patient, date, transcript_preview, summary, diseases"
+
+def init_archive(conn):
+    # 归档库中的表结构与主库对应的表一致
+    conn.execute('''CREATE TABLE IF NOT EXISTS archive.history (
+        id INTEGER PRIMARY KEY,
+        visit_number INTEGER,
+        doctor TEXT,
+        patient TEXT,
+        date TEXT,
+        transcript_preview TEXT,
+        summary TEXT,
+        diseases TEXT
+    )''')
+    conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_history_patient ON history(patient, visit_number)")
+    conn.execute('''CREATE TABLE IF NOT EXISTS archive.transcripts (
+        record_id INTEGER PRIMARY KEY,
+        size INTEGER,
+        data BLOB
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS archive.summary_revisions (
+        id INTEGER PRIMARY KEY,
+        record_id INTEGER NOT NULL,
+        revision INTEGER NOT NULL,
+        summary TEXT,
+        created_at TEXT,
+        UNIQUE(record_id, revision)
+    )''')
+
+
+def archive_sessions(database, before, batch_size=ARCHIVE_BATCH):
+    # 把就诊日期早于 before 的记录的转录全文和总结修订移到归档库（附带一份 history 行，归档库可以单独使用）。
+    # history 中保留元数据、预览和当前总结，就诊次数、时间线、诊断查询和长期总结不受影响。
+    # WAL 模式下跨库事务不保证整体原子性，所以先复制并提交，再从主库删除已确认复制的行；中途失败可以直接重跑
+    conn = database.attach_archive(create=True)
+    with database.transaction():
+        init_archive(conn)
+    moved, raw_bytes, stored_bytes = 0, 0, 0
+    while True:
+        with timed("db_write", op="archive_sessions") as stats, database.transaction():
+            ids = [row[0] for row in conn.execute(
+                """SELECT t.record_id FROM main.transcripts t JOIN main.history h ON h.id = t.record_id
+                   WHERE h.date < ? ORDER BY t.record_id LIMIT ?""",
+                (before, batch_size)
+            )]
+            if not ids:
+                break
+            marks = ", ".join("?" * len(ids))
+            conn.execute(f"INSERT OR REPLACE INTO archive.history ({ARCHIVE_HISTORY_COLUMNS}) "
+                         f"SELECT {ARCHIVE_HISTORY_COLUMNS} FROM main.history WHERE id IN ({marks})", ids)
+            conn.execute(f"INSERT OR REPLACE INTO archive.transcripts (record_id, size, data) "
+                         f"SELECT record_id, size, data FROM main.transcripts WHERE record_id IN ({marks})", ids)
+            conn.execute(f"INSERT OR REPLACE INTO archive.summary_revisions (id, record_id, revision, summary, created_at) "
+                         f"SELECT id, record_id, revision, summary, created_at FROM main.summary_revisions "
+                         f"WHERE record_id IN ({marks})", ids)
+            size, stored = conn.execute(
+                f"SELECT COALESCE(SUM(size), 0), COALESCE(SUM(length(data)), 0) FROM main.transcripts "
+                f"WHERE record_id IN ({marks})", ids
+            ).fetchone()
+            stats["rows"] = len(ids)
+        with database.transaction():
+            conn.execute(f"DELETE FROM main.summary_revisions WHERE record_id IN ({marks}) "
+                         f"AND id IN (SELECT id FROM archive.summary_revisions)", ids)
+            conn.execute(f"DELETE FROM main.transcripts WHERE record_id IN ({marks}) "
+                         f"AND record_id IN (SELECT record_id FROM archive.transcripts)", ids)
+        moved += len(ids)
+        raw_bytes += size
+        stored_bytes += stored
+    return {"sessions": moved, "raw_bytes": raw_bytes, "stored_bytes": stored_bytes}
+
+
+def compact_database(database):
+    # 归档后全文索引中留有删除标记，合并索引段后再 VACUUM 才能真正缩小文件
+    database.execute("INSERT INTO history_fts(history_fts) VALUES ('optimize')")
+    database.execute("INSERT INTO history_bigrams(history_bigrams) VALUES ('optimize')")
+    database.execute("VACUUM")
+    database.execute("PRAGMA wal_checkpoint(TRUNCATE)")
@@ -0,0 +1,97 @@
+import os
+import threading
+
+# Document text extraction
+# 按页/段落逐块产出文本，最后一次性拼接；大 PDF 按页分片交给进程池并行解析。
+# 进程池在第一次遇到大 PDF 时创建并一直复用；使用 spawn 启动子进程，
+# 不会 fork 带着界面线程、数据库连接和任务队列的主进程
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 50 * 1024 * 1024))
+MAX_PDF_PAGES = int(os.getenv("MAX_PDF_PAGES", 1000))
+PARALLEL_PAGE_THRESHOLD = 64   # 页数超过该值时才启用进程池
+PAGES_PER_TASK = 32
+MAX_PROCESSES = min(os.cpu_count() or 1, 4)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            _pool = ProcessPoolExecutor(max_workers=MAX_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _reset_pool(pool):
+    # 子进程异常退出后进程池不可再用，下次调用时重新创建
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_txt(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        yield from f
+
+
+def _extract_pdf_range(path, start, end):
+    import PyPDF2
+    reader = PyPDF2.PdfReader(path)
+    return [reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+
+def iter_pdf_pages(path, max_pages=MAX_PDF_PAGES):
+    import PyPDF2
+    reader = PyPDF2.PdfReader(path)
+    total = len(reader.pages)
+    if total > max_pages:
+        raise ValueError(f"PDF has {total} pages; the limit is {max_pages}.")
+
+    if total <= PARALLEL_PAGE_THRESHOLD or MAX_PROCESSES < 2:
+        for page in reader.pages:
+            yield page.extract_text() or ""
+        return
+
+    from concurrent.futures.process import BrokenProcessPool
+    ranges = [(start, min(start + PAGES_PER_TASK, total)) for start in range(0, total, PAGES_PER_TASK)]
+    pool = get_pool()
+    futures = [pool.submit(_extract_pdf_range, path, start, end) for start, end in ranges]
+    try:
+        for future in futures:
+            yield from future.result()
+    except BrokenProcessPool:
+        _reset_pool(pool)
+        raise
+    finally:
+        # 提前结束（出错或调用方不再读取）时取消还没开始的分片
+        for future in futures:
+            future.cancel()
+
+
+def iter_docx_paragraphs(path):
+    import docx
+    doc = docx.Document(path)
+    for para in doc.paragraphs:
+        yield para.text
+
+
+def extract_text(path):
+    size = os.path.getsize(path)
+    if size > MAX_UPLOAD_BYTES:
+        raise ValueError(f"File is {size // (1024 * 1024)} MB; the limit is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB.")
+
+    filename = path.lower()
+    if filename.endswith('.txt'):
+        return "".join(iter_txt(path))
+    elif filename.endswith('.pdf'):
+        return "\n".join(iter_pdf_pages(path))
+    elif filename.endswith('.docx'):
+        return "\n".join(iter_docx_paragraphs(path))
+    else:
+        raise ValueError("Unsupported file type: only .txt, .pdf, .docx supported!")
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import metrics
+from summarize import estimate_tokens
+
+# OpenAI API gateway
+# 所有 API 调用都经过这里：按请求数和 token 数限流（令牌桶）、失败时带抖动的指数退避重试、
+# 每次调用设置超时；完全相同的并发请求只向上游发送一次，结果共享。
+# 对外接口与 OpenAI 客户端一致（chat.completions.create / audio.transcriptions.create），可以直接替换 client
+
+CHAT_RPM = float(os.getenv("OPENAI_CHAT_RPM", 500))
+CHAT_TPM = float(os.getenv("OPENAI_CHAT_TPM", 30000))
+AUDIO_RPM = float(os.getenv("OPENAI_AUDIO_RPM", 50))
+CHAT_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", 120))
+AUDIO_TIMEOUT = float(os.getenv("OPENAI_AUDIO_TIMEOUT", 300))
+MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 5))
+RETRY_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+DEFAULT_COMPLETION_TOKENS = 1000   # 请求未指定 max_tokens 时预留的输出 token 数
+
+RETRY_STATUS = {408, 409, 429}
+RETRY_ERRORS = ("APITimeoutError", "APIConnectionError", "Timeout", "ConnectError", "ReadTimeout")
+
+
+class TokenBucket:
+    # 预留式令牌桶：余额可以为负，调用方按返回的等待时间睡眠，先到先得且不需要轮询
+    def __init__(self, per_minute, burst=None):
+        self.rate = per_minute / 60.0
+        self.capacity = burst or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount=1):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= min(amount, self.capacity)
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+def retry_reason(error):
+    # 可重试的错误返回原因（用于统计），否则返回 None
+    status = getattr(error, "status_code", None)
+    if status in RETRY_STATUS or (status is not None and status >= 500):
+        return str(status)
+    if isinstance(error, (TimeoutError, ConnectionError)) or type(error).__name__ in RETRY_ERRORS:
+        return "timeout" if "Timeout" in type(error).__name__ else "connection"
+    return None
+
+
+def retry_after(error):
+    # 429/503 响应中服务端建议的等待时间（秒）
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return min(float(headers.get("retry-after")), MAX_BACKOFF)
+    except (TypeError, ValueError):
+        return None
+
+
+def request_key(kind, payload):
+    h = hashlib.sha256(kind.encode("utf-8"))
+    h.update(json.dumps(payload, sort_keys=True, default=str).encode("utf-8"))
+    return h.hexdigest()
+
+
+class ApiGateway:
+    def __init__(self, client, chat_rpm=CHAT_RPM, chat_tpm=CHAT_TPM, audio_rpm=AUDIO_RPM,
+                 chat_timeout=CHAT_TIMEOUT, audio_timeout=AUDIO_TIMEOUT, max_retries=MAX_RETRIES,
+                 backoff=RETRY_BACKOFF, max_backoff=MAX_BACKOFF):
+        self.client = client
+        self.buckets = {
+            "chat": [TokenBucket(chat_rpm)] if chat_rpm else [],
+            "chat_tokens": [TokenBucket(chat_tpm)] if chat_tpm else [],
+            "audio": [TokenBucket(audio_rpm)] if audio_rpm else [],
+        }
+        self.timeouts = {"chat": chat_timeout, "audio": audio_timeout}
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.in_flight = 0
+        self.waiting = 0
+        self.retries = 0
+        self.throttled = 0
+        self.deduplicated = 0
+        self._pause_until = {"chat": 0.0, "audio": 0.0}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat_create))
+        self.audio = SimpleNamespace(transcriptions=SimpleNamespace(create=self._transcribe))
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": self.in_flight, "waiting": self.waiting, "retries": self.retries,
+                    "throttled": self.throttled, "deduplicated": self.deduplicated,
+                    "pending_keys": len(self._pending)}
+
+    def _chat_create(self, **kwargs):
+        prompt = "".join(str(m.get("content", "")) for m in kwargs.get("messages", []))
+        tokens = estimate_tokens(prompt) + (kwargs.get("max_tokens") or DEFAULT_COMPLETION_TOKENS)
+        create = self.client.chat.completions.create
+        if kwargs.get("stream"):
+            # 流式响应无法共享给多个调用方，不做合并；只重试建立连接的阶段
+            return self._send("chat", create, kwargs, tokens)
+        return self._dedup(request_key("chat", kwargs), lambda: self._send("chat", create, kwargs, tokens))
+
+    def _transcribe(self, file, model, **kwargs):
+        create = self.client.audio.transcriptions.create
+        kwargs = dict(kwargs, file=file, model=model)
+        data = file[1] if isinstance(file, tuple) else None
+        if not isinstance(data, (bytes, bytearray)):
+            return self._send("audio", create, kwargs, 0)
+        # 相同的音频内容（与文件名无关）只转录一次
+        key = request_key("audio", {"model": model, "data": hashlib.sha256(data).hexdigest(),
+                                    **{k: v for k, v in kwargs.items() if k not in ("file", "model")}})
+        return self._dedup(key, lambda: self._send("audio", create, kwargs, 0))
+
+    def _dedup(self, key, send):
+        with self._lock:
+            future = self._pending.get(key)
+            owner = future is None
+            if owner:
+                future = self._pending[key] = Future()
+            else:
+                self.deduplicated += 1
+        if not owner:
+            metrics.count("api_deduplicated_total")
+            return future.result()
+        try:
+            result = send()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def _throttle(self, kind, tokens):
+        delay = max([bucket.reserve() for bucket in self.buckets[kind]] +
+                    [bucket.reserve(tokens) for bucket in self.buckets.get(f"{kind}_tokens", [])] + [0.0])
+        # 收到 429 后同类请求一起暂停到服务端建议的时间
+        delay = max(delay, self._pause_until[kind] - time.monotonic())
+        if delay <= 0:
+            return
+        with self._lock:
+            self.waiting += 1
+            self.throttled += 1
+        metrics.count("api_throttled_total", api=kind)
+        metrics.count("api_throttle_seconds_total", delay, api=kind)
+        try:
+            time.sleep(delay)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def _send(self, kind, create, kwargs, tokens):
+        kwargs = dict(kwargs)
+        kwargs.setdefault("timeout", self.timeouts[kind])
+        for attempt in range(self.max_retries + 1):
+            self._throttle(kind, tokens)
+            with self._lock:
+                self.in_flight += 1
+            try:
+                return create(**kwargs)
+            except Exception as e:
+                reason = retry_reason(e)
+                if reason is None or attempt == self.max_retries:
+                    metrics.count("api_errors_total", api=kind, reason=reason or type(e).__name__)
+                    raise
+                wait = retry_after(e)
+                if wait is not None:
+                    with self._lock:
+                        self._pause_until[kind] = max(self._pause_until[kind], time.monotonic() + wait)
+                else:
+                    wait = min(self.backoff * (2 ** attempt), self.max_backoff) * random.uniform(0.5, 1.5)
+                with self._lock:
+                    self.retries += 1
+                metrics.count("api_retries_total", api=kind, reason=reason)
+                time.sleep(wait)
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
@@ -0,0 +1,220 @@
+import json
+import os
+import shutil
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+import metrics
+
+# Background job queue
+# 长耗时的处理（转录、总结、保存）放到后台线程池执行，任务状态持久化在数据库中，
+# 界面只需轮询状态；应用重启后未完成的任务会重新排队
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))
+JOB_FILES_DIR = os.getenv("JOB_FILES_DIR", "job_files")
+MAX_ATTEMPTS = 3
+JOB_RETENTION_HOURS = float(os.getenv("JOB_RETENTION_HOURS", 24))   # 已完成/失败的任务保留多久
+PRUNE_INTERVAL = 3600
+
+# 每个阶段同时运行的任务数上限，可通过环境变量 JOB_LIMIT_<STAGE> 调整
+DEFAULT_STAGE_LIMITS = {"transcribe": 2, "summarize": 2, "save": 1, "longitudinal": 1}
+
+
+def stage_limits_from_env(defaults=DEFAULT_STAGE_LIMITS):
+    return {stage: int(os.getenv(f"JOB_LIMIT_{stage.upper()}", limit)) for stage, limit in defaults.items()}
+
+
+class JobQueue:
+    def __init__(self, database, handler, workers=JOB_WORKERS, stage_limits=None, files_dir=JOB_FILES_DIR,
+                 retention_hours=JOB_RETENTION_HOURS):
+        self.db = database
+        self.handler = handler
+        self.workers = workers
+        self.files_dir = files_dir
+        self.retention = retention_hours * 3600
+        self._pruned_at = 0.0
+        self._stage_limits = stage_limits_from_env() if stage_limits is None else stage_limits
+        self._semaphores = {stage: threading.BoundedSemaphore(n) for stage, n in self._stage_limits.items()}
+        self._partials = {}
+        self._wakeup = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        with self.db.transaction() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT,
+                status TEXT,
+                stage TEXT,
+                payload TEXT,
+                result TEXT,
+                error TEXT,
+                attempts INTEGER DEFAULT 0,
+                created_at REAL,
+                updated_at REAL
+            )''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, id)")
+
+    def start(self):
+        # 上次退出时仍在运行的任务重新排队；还在复制上传文件（pending）的任务不完整，标记为失败
+        self.db.execute(
+            "UPDATE jobs SET status = 'queued', updated_at = ? WHERE status = 'running'", (time.time(),)
+        )
+        self.db.execute(
+            "UPDATE jobs SET status = 'failed', error = 'Interrupted while saving uploads', updated_at = ? "
+            "WHERE status = 'pending'", (time.time(),)
+        )
+        self.prune()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout=None):
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify_all()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def submit(self, kind, payload, files=None):
+        now = time.time()
+        job_id = self.db.execute(
+            "INSERT INTO jobs (kind, status, stage, payload, result, created_at, updated_at) VALUES (?,?,?,?,?,?,?)",
+            (kind, "pending", "queued", "{}", "{}", now, now)
+        ).lastrowid
+        # 上传文件复制到任务目录，避免重启后临时文件被清理（复制在事务之外进行，不占用写锁）；
+        # 复制失败（例如临时文件已被 gradio 删除）时任务标记为失败，不会一直停在 pending
+        payload = dict(payload)
+        try:
+            for name, path in (files or {}).items():
+                if not path:
+                    payload[name] = None
+                    continue
+                job_dir = os.path.join(self.files_dir, str(job_id))
+                os.makedirs(job_dir, exist_ok=True)
+                payload[name] = shutil.copy(path, os.path.join(job_dir, os.path.basename(path)))
+        except Exception as e:
+            self._set(job_id, status="failed", error=f"Could not save upload: {e}")
+            self._remove_files(job_id)
+            raise
+        self.db.execute(
+            "UPDATE jobs SET status = 'queued', payload = ? WHERE id = ?", (json.dumps(payload), job_id)
+        )
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_id
+
+    def get(self, job_id):
+        row = self.db.execute(
+            "SELECT id, kind, status, stage, payload, result, error, attempts FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row[0], "kind": row[1], "status": row[2], "stage": row[3],
+            "payload": json.loads(row[4]), "result": json.loads(row[5]), "error": row[6], "attempts": row[7],
+        }
+
+    def update_result(self, job_id, drop=(), **fields):
+        # drop：不再需要的字段（例如已写入 history 的文本）从结果中删除
+        with self.db.transaction() as conn:
+            row = conn.execute("SELECT result FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            result = json.loads(row[0])
+            result.update(fields)
+            for key in drop:
+                result.pop(key, None)
+            conn.execute(
+                "UPDATE jobs SET result = ?, updated_at = ? WHERE id = ?", (json.dumps(result), time.time(), job_id)
+            )
+
+    @contextmanager
+    def stage(self, job_id, name):
+        # 按阶段限流：拿到该阶段的名额后才更新任务状态
+        semaphore = self._semaphores.get(name)
+        if semaphore:
+            start = time.perf_counter()
+            semaphore.acquire()
+            metrics.observe("job_stage_wait_seconds", time.perf_counter() - start, stage=name)
+        try:
+            self._set(job_id, stage=name)
+            with metrics.timed("job_stage", stage=name):
+                yield
+        finally:
+            if semaphore:
+                semaphore.release()
+
+    def set_partial(self, job_id, parts):
+        # 流式输出的中间结果只保存在内存中，供界面轮询
+        self._partials[job_id] = parts
+
+    def partial(self, job_id):
+        parts = self._partials.get(job_id)
+        return "".join(parts) if parts is not None else None
+
+    def prune(self):
+        # 删除超过保留期的已完成/失败任务及其残留的上传文件
+        self._pruned_at = time.time()
+        with self.db.transaction() as conn:
+            ids = [row[0] for row in conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ? RETURNING id",
+                (self._pruned_at - self.retention,)
+            )]
+        for job_id in ids:
+            self._remove_files(job_id)
+        return len(ids)
+
+    def queue_depth(self):
+        return dict(self.db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def _set(self, job_id, **fields):
+        fields["updated_at"] = time.time()
+        self.db.execute(
+            f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+            list(fields.values()) + [job_id]
+        )
+
+    def _remove_files(self, job_id):
+        shutil.rmtree(os.path.join(self.files_dir, str(job_id)), ignore_errors=True)
+
+    def _claim(self):
+        with self.db.transaction() as conn:
+            return conn.execute(
+                """UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ?
+                   WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1)
+                   RETURNING id, attempts""",
+                (time.time(),)
+            ).fetchone()
+
+    def _worker(self):
+        while True:
+            with self._wakeup:
+                if self._stopping:
+                    return
+            if time.time() - self._pruned_at > PRUNE_INTERVAL:
+                self.prune()
+            claimed = self._claim()
+            if claimed is None:
+                with self._wakeup:
+                    if not self._stopping:
+                        self._wakeup.wait(timeout=1.0)
+                continue
+
+            job_id, attempts = claimed
+            if attempts > MAX_ATTEMPTS:
+                self._set(job_id, status="failed", error="Too many attempts")
+                self._remove_files(job_id)
+                continue
+            try:
+                self.handler(self, self.get(job_id))
+            except Exception as e:
+                traceback.print_exc()
+                self._set(job_id, status="failed", error=str(e))
+            else:
+                # 输入已处理完毕，payload 中手动输入的文本不再保留
+                self._set(job_id, status="done", stage="done", payload="{}")
+            finally:
+                self._remove_files(job_id)
+                self._partials.pop(job_id, None)
@@ -0,0 +1,208 @@
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from transcription import OVERLAP_MS, find_cut_points, stitch_transcripts, _export_chunk
+
+# Live transcription
+# 录音过程中把麦克风音频缓存成滚动窗口：窗口录满后在目标长度附近的静音处切开（相邻窗口保留少量重叠），
+# 立即在后台转录，录音继续进行；界面显示已完成窗口拼接出的转录。停止录音时只剩最后一个窗口需要处理
+#
+# transcribe(wav_bytes, name) -> text 由调用方传入，可用替身离线回放录音文件：
+#   python live.py recording.wav --stub
+
+LIVE_WINDOW_MS = int(float(os.getenv("LIVE_WINDOW_SECONDS", 30)) * 1000)
+LIVE_SEARCH_MS = 5000        # 在窗口末尾前后多大范围内寻找静音
+LIVE_WORKERS = 2
+LIVE_RETRIES = int(os.getenv("LIVE_RETRIES", 2))   # 停止录音时失败窗口的重试次数
+GAP_MARKER = "[...]"         # 重试后仍失败的窗口在转录中的占位
+SAMPLE_RATE = 16000          # 缓存统一为 16kHz 单声道 16-bit（与 Whisper 内部一致）
+BYTES_PER_MS = SAMPLE_RATE * 2 // 1000
+
+
+def to_segment(sample_rate, samples):
+    # gradio numpy 格式：(采样率, int16/float 数组)，多声道时形状为 (n, channels)
+    import numpy as np
+    from pydub import AudioSegment
+
+    samples = np.asarray(samples)
+    if samples.dtype.kind == "f":
+        samples = np.clip(samples, -1.0, 1.0) * 32767
+    channels = samples.shape[1] if samples.ndim == 2 else 1
+    segment = AudioSegment(data=samples.astype("<i2").tobytes(), sample_width=2,
+                           frame_rate=sample_rate, channels=channels)
+    return segment.set_channels(1).set_frame_rate(SAMPLE_RATE)
+
+
+class LiveSession:
+    def __init__(self, transcribe, window_ms=LIVE_WINDOW_MS, overlap_ms=OVERLAP_MS,
+                 search_ms=LIVE_SEARCH_MS, workers=LIVE_WORKERS, retries=LIVE_RETRIES):
+        self.transcribe = transcribe
+        self.window_ms = window_ms
+        self.overlap_ms = overlap_ms
+        self.search_ms = search_ms
+        self.retries = retries
+        # 只保留还没切出去的音频（含上一窗口末尾的重叠部分），起点在整段录音中的位置为 _offset_ms
+        self._pcm = bytearray()
+        self._offset_ms = 0
+        self._cut_ms = 0             # 下一个窗口的起点（不含重叠）
+        self.windows = []            # 已提交的窗口 (start_ms, end_ms)，含重叠
+        self.failed = []             # finish() 后仍未转录成功的窗口序号
+        self._futures = []
+        self._data = {}              # 窗口序号 -> 导出的 WAV，转录成功后释放，失败时用于重试
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self.last_fed = time.monotonic()   # 最近一次收到音频的时间，用于回收标签页关闭后遗留的会话
+
+    @property
+    def duration_ms(self):
+        return self._offset_ms + len(self._pcm) // BYTES_PER_MS
+
+    def feed(self, sample_rate, samples):
+        segment = to_segment(sample_rate, samples)
+        self.last_fed = time.monotonic()
+        with self._lock:
+            self._pcm += segment.raw_data
+            # 缓存中剩余的音频足够一个窗口加上寻找切点的余量时切出一个窗口
+            while self.duration_ms - self._cut_ms > self.window_ms + self.search_ms:
+                self._cut_window()
+
+    def _cut_window(self):
+        from pydub import AudioSegment
+
+        audio = AudioSegment(data=bytes(self._pcm), sample_width=2, frame_rate=SAMPLE_RATE, channels=1)
+        target = self._cut_ms - self._offset_ms + self.window_ms
+        cuts = find_cut_points(audio, chunk_ms=target, search_ms=self.search_ms)
+        cut = cuts[0] if cuts else target
+        self._submit(audio, 0, cut)
+        self._cut_ms = self._offset_ms + cut
+        # 丢弃已切出的音频，只保留下一窗口需要的重叠部分
+        keep_from = max(cut - self.overlap_ms, 0)
+        del self._pcm[:keep_from * BYTES_PER_MS]
+        self._offset_ms += keep_from
+
+    def _submit(self, audio, start, end):
+        index = len(self._futures)
+        self.windows.append((self._offset_ms + start, self._offset_ms + end))
+        data = _export_chunk(audio, start, end)
+        self._data[index] = data
+        future = self._pool.submit(self.transcribe, data, f"live_{index}.wav")
+        future.add_done_callback(partial(self._release, index))
+        self._futures.append(future)
+
+    def _release(self, index, future):
+        # 转录成功后不再需要保留该窗口的音频
+        if not future.cancelled() and future.exception() is None:
+            self._data.pop(index, None)
+
+    def _result(self, index):
+        # 等待窗口完成；失败时用保留的音频重试，仍失败返回 None
+        future = self._futures[index]
+        try:
+            return future.result()
+        except Exception:
+            pass
+        for _ in range(self.retries):
+            try:
+                text = self.transcribe(self._data[index], f"live_{index}.wav")
+            except Exception:
+                continue
+            self._data.pop(index, None)
+            return text
+        return None
+
+    def transcript(self):
+        # 按顺序拼接已完成的窗口，遇到未完成（或失败）的窗口就停下
+        texts = []
+        for future in list(self._futures):
+            if not future.done() or future.exception() is not None:
+                break
+            texts.append(future.result())
+        return stitch_transcripts(texts)
+
+    def pending(self):
+        return sum(1 for future in list(self._futures) if not future.done())
+
+    def finish(self):
+        # 停止录音：剩余音频作为最后一个窗口提交，等待所有窗口完成后返回完整转录；
+        # 失败的窗口用保留的音频重试，仍失败时跳过并记入 failed，其余窗口照常拼接（缺口处为 GAP_MARKER）
+        from pydub import AudioSegment
+
+        with self._lock:
+            if self.duration_ms > self._cut_ms:
+                audio = AudioSegment(data=bytes(self._pcm), sample_width=2, frame_rate=SAMPLE_RATE, channels=1)
+                self._submit(audio, 0, len(audio))
+                self._cut_ms = self.duration_ms
+                self._pcm = bytearray()
+        try:
+            parts, run = [], []
+            for index in range(len(self._futures)):
+                text = self._result(index)
+                if text is None:
+                    self.failed.append(index)
+                    parts.append(stitch_transcripts(run))
+                    parts.append(GAP_MARKER)
+                    run = []
+                else:
+                    run.append(text)
+            parts.append(stitch_transcripts(run))
+            return "\n\n".join(part for part in parts if part)
+        finally:
+            self._data.clear()
+            self._pool.shutdown(wait=False)
+
+    def discard(self):
+        for future in self._futures:
+            future.cancel()
+        self._data.clear()
+        self._pool.shutdown(wait=False)
+
+
+def replay(path, transcribe, chunk_ms=500, **options):
+    # 把录音文件按 chunk_ms 切成小块依次送入，模拟麦克风流式输入
+    import numpy as np
+    from pydub import AudioSegment
+
+    audio = AudioSegment.from_file(path).set_sample_width(2)
+    session = LiveSession(transcribe, **options)
+    for start in range(0, len(audio), chunk_ms):
+        piece = audio[start:start + chunk_ms]
+        samples = np.frombuffer(piece.raw_data, dtype="<i2")
+        if piece.channels > 1:
+            samples = samples.reshape(-1, piece.channels)
+        session.feed(piece.frame_rate, samples)
+    return session.finish(), session.windows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a recording through the live transcription windows.")
+    parser.add_argument("audio", help="pre-recorded audio file (WAV works without ffmpeg)")
+    parser.add_argument("--window", type=float, default=LIVE_WINDOW_MS / 1000, help="window length in seconds")
+    parser.add_argument("--chunk", type=int, default=500, help="simulated microphone chunk length (ms)")
+    parser.add_argument("--stub", action="store_true", help="label each window instead of calling the API")
+    args = parser.parse_args(argv)
+
+    if args.stub:
+        def transcribe(data, name):
+            return f"[{name}: {len(data)} bytes]"
+    else:
+        import app
+
+        def transcribe(data, name):
+            return app.transcribe_live_window(data, name)
+
+    text, windows = replay(args.audio, transcribe, args.chunk, window_ms=int(args.window * 1000))
+    for i, (start, end) in enumerate(windows):
+        print(f"window {i}: {start / 1000:.1f}s - {end / 1000:.1f}s")
+    if GAP_MARKER in text:
+        print(f"some windows could not be transcribed (shown as {GAP_MARKER})")
+    print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,243 @@
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Instrumentation
+# 记录各处理阶段耗时、API 延迟、token 和字节数；以 Prometheus 文本格式在本地端口提供，
+# 并可逐条写入 JSON 行日志。未启用时计时器直接返回，几乎没有开销
+#
+#   METRICS_ENABLED=1        启用统计
+#   METRICS_PORT=9464        /metrics 端口（只监听 127.0.0.1，0 表示不启动）
+#   METRICS_LOG=metrics.jsonl  结构化日志文件（"-" 表示输出到 stderr）
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0").lower() in ("1", "true", "yes")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9464))
+METRICS_LOG = os.getenv("METRICS_LOG", "")
+METRICS_WINDOW = float(os.getenv("METRICS_WINDOW", 300))   # 滚动分位数的时间窗口（秒）
+WINDOW_SAMPLES = 1024
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+QUANTILES = (0.5, 0.95, 0.99)
+
+enabled = METRICS_ENABLED
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_gauges = {}
+_gauge_pool = None   # 抓取时的 gauge 都在同一个线程上计算，查询数据库的 gauge 只占用一个连接
+_log_file = None
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        # 最近的样本，用于计算时间窗口内的分位数
+        self.recent = deque(maxlen=WINDOW_SAMPLES)
+
+    def observe(self, value, now):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append((now, value))
+
+    def quantiles(self, now, window=METRICS_WINDOW):
+        values = sorted(v for t, v in self.recent if now - t <= window)
+        if not values:
+            return {}
+        return {q: values[min(int(q * len(values)), len(values) - 1)] for q in QUANTILES}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def configure(enable=True, log_path=METRICS_LOG):
+    global enabled, _log_file
+    with _lock:
+        enabled = enable
+        if _log_file not in (None, sys.stderr):
+            _log_file.close()
+        if not enable or not log_path:
+            _log_file = None
+        elif log_path == "-":
+            _log_file = sys.stderr
+        else:
+            _log_file = open(log_path, "a", encoding="utf-8", buffering=1)
+
+
+def count(name, value=1, **labels):
+    if not enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    if not enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = Histogram()
+        hist.observe(value, time.monotonic())
+
+
+def gauge(name, fn):
+    # fn() 在抓取时才调用，返回数值或 {标签值: 数值}
+    with _lock:
+        _gauges[name] = fn
+
+
+def log(event, **fields):
+    if _log_file is None:
+        return
+    line = json.dumps({"ts": round(time.time(), 3), "event": event, **fields}, ensure_ascii=False, default=str)
+    with _lock:
+        _log_file.write(line + "\n")
+
+
+@contextmanager
+def timed(name, **labels):
+    # 用法：with timed("stage", stage="transcribe") as info: ... info["bytes"] = n
+    # 耗时记入 <name>_seconds 直方图，info 中的数值记入 <name>_<key>_total 计数器
+    info = {}
+    if not enabled:
+        yield info
+        return
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield info
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        observe(f"{name}_seconds", elapsed, **labels)
+        count(f"{name}_total", 1, status=status, **labels)
+        for field, value in info.items():
+            if isinstance(value, (int, float)):
+                count(f"{name}_{field}_total", value, **labels)
+        log(name, seconds=round(elapsed, 4), status=status, **labels, **info)
+
+
+def record_usage(info, response):
+    # 记录 API 响应中的 token 用量（流式响应只有最后一块带 usage）
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        info["prompt_tokens"] = getattr(usage, "prompt_tokens", 0) or 0
+        info["completion_tokens"] = getattr(usage, "completion_tokens", 0) or 0
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def render_prometheus():
+    now = time.monotonic()
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted(_histograms.items(), key=lambda item: item[0])
+        snapshots = [(key, list(h.counts), h.sum, h.count, h.buckets, h.quantiles(now)) for key, h in histograms]
+        gauges = sorted(_gauges.items())
+
+    typed = set()
+    for (name, labels), value in counters:
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    for (name, labels), counts, total, n, buckets, quantiles in snapshots:
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, c in zip(list(buckets) + ["+Inf"], counts):
+            cumulative += c
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total:.6f}")
+        lines.append(f"{name}_count{_format_labels(labels)} {n}")
+
+    # 最近 METRICS_WINDOW 秒内的分位数（单独作为 gauge 输出）
+    for (name, labels), _, _, _, _, quantiles in snapshots:
+        if f"{name}_recent" not in typed:
+            typed.add(f"{name}_recent")
+            lines.append(f"# TYPE {name}_recent gauge")
+        for q, value in quantiles.items():
+            lines.append(f"{name}_recent{_format_labels(labels, [('quantile', q)])} {value:.6f}")
+
+    for name, value in _read_gauges(gauges):
+        lines.append(f"# TYPE {name} gauge")
+        if isinstance(value, dict):
+            for label, v in sorted(value.items()):
+                lines.append(f"{name}{_format_labels([('state', label)])} {v}")
+        else:
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _read_gauges(gauges):
+    global _gauge_pool
+    if not gauges:
+        return []
+    with _lock:
+        if _gauge_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _gauge_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="metrics-gauges")
+
+    def read():
+        values = []
+        for name, fn in gauges:
+            try:
+                values.append((name, fn()))
+            except Exception:
+                continue
+        return values
+
+    return _gauge_pool.submit(read).result()
+
+
+def start_server(port=METRICS_PORT, host="127.0.0.1"):
+    if not enabled or not port:
+        return None
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"Metrics available at http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+if enabled:
+    configure(True, METRICS_LOG)
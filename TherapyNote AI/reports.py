@@ -0,0 +1,82 @@
+import hashlib
+import os
+import threading
+
+# PDF report store
+# 报告只在用户点击下载时生成；按 记录 id + 内容哈希 缓存到磁盘，内容未变时直接复用，
+# 总大小超过上限时按最近使用时间（LRU）淘汰
+
+REPORTS_DIR = os.getenv("REPORTS_DIR", "reports")
+REPORTS_MAX_BYTES = int(os.getenv("REPORTS_MAX_BYTES", 200 * 1024 * 1024))
+
+
+def report_hash(*fields):
+    h = hashlib.sha256()
+    for field in fields:
+        h.update(str(field).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()[:16]
+
+
+class ReportStore:
+    def __init__(self, render, directory=REPORTS_DIR, max_bytes=REPORTS_MAX_BYTES):
+        # render(doctor, patient, date, session_id, transcript, summary) -> 含 PDF 内容的 BytesIO
+        self.render = render
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.renders = 0
+        self._lock = threading.Lock()
+
+    def get(self, record_id, doctor, patient, date, session_id, transcript, summary):
+        digest = report_hash(doctor, patient, date, session_id, transcript, summary)
+        path = os.path.join(self.directory, f"{record_id}-{digest}.pdf")
+        try:
+            os.utime(path)  # 更新最近使用时间；文件不存在（或刚被其他线程淘汰）时重新生成
+        except FileNotFoundError:
+            pass
+        else:
+            with self._lock:
+                self.hits += 1
+            return path
+
+        os.makedirs(self.directory, exist_ok=True)
+        buffer = self.render(doctor, patient, date, session_id, transcript, summary)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(buffer.getvalue())
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.renders += 1
+            self._remove_stale(record_id, path)
+            self._evict(keep=path)
+        return path
+
+    def _remove_stale(self, record_id, current):
+        # 同一记录的旧版本（内容已修改）不再需要
+        prefix = f"{record_id}-"
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith(prefix) and name.endswith(".pdf") and path != current:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _evict(self, keep):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".pdf"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,69 @@
+import re
+
+# Structured report sections
+# 把模型生成的总结按八个固定小节拆开，并从“可能的诊断”中提取规范化的诊断名称
+
+SECTIONS = [
+    ("chief_complaint", ["chief complaint", "主诉"]),
+    ("history_present_illness", ["history of present illness", "现病史"]),
+    ("mental_status", ["mental status examination", "mental status exam", "mental status", "精神状态检查", "精神检查"]),
+    ("assessment", ["assessment", "评估"]),
+    ("possible_diagnoses", ["possible diagnoses", "possible diagnosis", "diagnoses", "可能的诊断", "诊断"]),
+    ("recommendations", ["recommendations", "recommendation", "建议"]),
+    ("plan", ["treatment plan", "plan", "计划", "治疗计划"]),
+    ("follow_up", ["follow-up", "follow up", "followup", "随访", "复诊"]),
+]
+SECTION_KEYS = [key for key, _ in SECTIONS]
+
+_TITLES = sorted(((title, key) for key, titles in SECTIONS for title in titles), key=lambda t: -len(t[0]))
+# 小节标题行：可带 markdown 标题/加粗/编号前缀，标题后可直接跟冒号和内容
+_HEADER_RE = re.compile(
+    r"^[ \t]*(?:#+[ \t]*)?(?:\*\*|__)?[ \t]*(?:\d+[.)、][ \t]*)?(?:\*\*|__)?[ \t]*("
+    + "|".join(re.escape(title) for title, _ in _TITLES)
+    + r")[ \t]*(?:\*\*|__)?[ \t]*(?:[:：][ \t]*(?:\*\*|__)?[ \t]*(.*?)|)[ \t]*$",
+    re.IGNORECASE | re.MULTILINE,
+)
+_TITLE_KEYS = {title: key for title, key in _TITLES}
+
+_RULE_RE = re.compile(r"^[ \t]*(?:-{3,}|\*{3,}|_{3,})[ \t]*$", re.MULTILINE)
+_BULLET_RE = re.compile(r"^\s*(?:[-*•·]|\d+[.)、]|[a-z][.)])\s*", re.IGNORECASE)
+
+
+def parse_sections(summary):
+    sections = dict.fromkeys(SECTION_KEYS, "")
+    # 去掉 markdown 分隔线，避免混入小节内容
+    summary = _RULE_RE.sub("", summary or "")
+    matches = list(_HEADER_RE.finditer(summary))
+    for i, m in enumerate(matches):
+        key = _TITLE_KEYS[m.group(1).lower()]
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(summary)
+        body = ((m.group(2) or "") + summary[m.end():end]).strip()
+        # 同一小节出现多次时合并
+        sections[key] = f"{sections[key]}\n{body}".strip() if sections[key] else body
+    return sections
+
+
+def normalize_diagnosis(label):
+    name = re.sub(r"\*\*|__|`", "", label)
+    name = re.sub(r"^\s*(?:rule out|r/o|排除)\s*[:：]?\s*", "", name, flags=re.IGNORECASE)
+    name = re.split(r"[:：]| - | – | — ", name, maxsplit=1)[0]
+    name = re.sub(r"\([^)]*\)|（[^）]*）", "", name)
+    # 逗号后是 DSM/ICD 的限定词（"Major Depressive Disorder, recurrent, moderate"），只保留基本诊断名称
+    name = re.split(r"[,，]", name, maxsplit=1)[0]
+    name = re.sub(r"\s+", " ", name).strip(" .,;，。；").lower()
+    return name
+
+
+def parse_diagnoses(diagnoses_text):
+    # 每行一个诊断（列表项）；单行时只按分号拆分，逗号属于诊断名称中的限定词
+    lines = [line for line in (diagnoses_text or "").splitlines() if line.strip()]
+    if len(lines) == 1:
+        lines = re.split(r"[;；]", lines[0])
+    result, seen = [], set()
+    for line in lines:
+        label = _BULLET_RE.sub("", line).strip()
+        name = normalize_diagnosis(label)
+        if re.search(r"\w", name) and name not in seen:
+            seen.add(name)
+            result.append((name, label))
+    return result
@@ -0,0 +1,90 @@
+import math
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import timed, record_usage
+
+# Map-reduce summarization
+# 转录文本超过单次调用的预算时，先按 token 预算切段并行总结，再把各段笔记合并（必要时逐层合并）
+
+SINGLE_PASS_TOKENS = 24000   # 不超过该预算的文本直接一次总结
+SEGMENT_TOKENS = 6000        # 每段的 token 上限
+MAX_WORKERS = 4
+MAX_LEVELS = 4
+
+SEGMENT_PROMPT = "Patient Info: {info}\nThis is part {index} of {total} of a therapy session transcript:\n{text}\nWrite concise clinical notes for this part only. Keep symptoms, history, mental status observations, risk factors, diagnoses discussed, and plans or follow-up items. Do not add information that is not in the text."
+MERGE_PROMPT = "Patient Info: {info}\nThese are clinical notes {index} of {total}, each covering consecutive parts of one therapy session:\n{text}\nMerge them into one set of concise clinical notes in session order. Keep symptoms, history, mental status observations, risk factors, diagnoses discussed, and plans or follow-up items."
+
+_CJK_RE = re.compile(r"[\u3400-\u9fff\u3000-\u303f\uff00-\uffef]")
+_SENTENCE_RE = re.compile(r"(?<=[.!?。！？])\s*")
+
+
+def estimate_tokens(text):
+    # 确定性的近似估算：中文按每字 1 个 token，其余按每 4 个字符 1 个 token
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def _units(text, max_tokens):
+    # 优先在段落处切分，其次在句子处，最后按字符硬切
+    for para in re.split(r"\n\s*\n|\n", text):
+        if not para.strip():
+            continue
+        if estimate_tokens(para) <= max_tokens:
+            yield para
+            continue
+        for sentence in _SENTENCE_RE.split(para):
+            if not sentence:
+                continue
+            while estimate_tokens(sentence) > max_tokens:
+                # 二分查找不超过预算的最长前缀（每个字符至多 1 个 token，长度 max_tokens 的前缀一定满足）
+                lo, hi = max_tokens, len(sentence)
+                while lo < hi:
+                    mid = (lo + hi + 1) // 2
+                    if estimate_tokens(sentence[:mid]) <= max_tokens:
+                        lo = mid
+                    else:
+                        hi = mid - 1
+                yield sentence[:lo]
+                sentence = sentence[lo:]
+            if sentence:
+                yield sentence
+
+
+def split_segments(text, max_tokens=SEGMENT_TOKENS):
+    segments, current, current_tokens = [], [], 0
+    for unit in _units(text, max_tokens):
+        tokens = estimate_tokens(unit) + 1
+        if current and current_tokens + tokens > max_tokens:
+            segments.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(unit)
+        current_tokens += tokens
+    if current:
+        segments.append("\n".join(current))
+    return segments
+
+
+def summarize_segments(client, segments, info, model, prompt=SEGMENT_PROMPT, max_workers=MAX_WORKERS):
+    def run(index, segment):
+        content = prompt.format(info=info, index=index + 1, total=len(segments), text=segment)
+        with timed("api", api="chat") as stats:
+            resp = client.chat.completions.create(model=model, messages=[{"role": "user", "content": content}])
+            record_usage(stats, resp)
+        return resp.choices[0].message.content
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(run, range(len(segments)), segments))
+
+
+def condense_transcript(client, text, info, model, single_pass_tokens=SINGLE_PASS_TOKENS,
+                        segment_tokens=SEGMENT_TOKENS, max_workers=MAX_WORKERS):
+    # 返回 (用于最终报告的文本, 是否经过了分段总结)
+    level = 0
+    while estimate_tokens(text) > single_pass_tokens and level < MAX_LEVELS:
+        segments = split_segments(text, segment_tokens)
+        prompt = SEGMENT_PROMPT if level == 0 else MERGE_PROMPT
+        notes = summarize_segments(client, segments, info, model, prompt, max_workers)
+        text = "\n\n".join(f"Part {i + 1}:\n{note}" for i, note in enumerate(notes))
+        level += 1
+    return text, level > 0
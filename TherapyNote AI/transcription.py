@@ -0,0 +1,132 @@
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from metrics import timed
+
+# Chunked Whisper transcription
+# 长录音按静音切分成若干段（段与段之间有少量重叠），并发送给 Whisper，最后按顺序拼接并去掉重叠部分
+
+CHUNK_MS = 5 * 60 * 1000        # 每段目标长度
+OVERLAP_MS = 1500               # 相邻两段的重叠长度
+SILENCE_SEARCH_MS = 15 * 1000   # 在目标切点前后多大范围内寻找静音
+MIN_SILENCE_MS = 400
+SILENCE_THRESH_DB = -16         # 相对整段平均音量
+MAX_WORKERS = 4
+MAX_RETRIES = 3
+RETRY_BACKOFF = 1.0
+MAX_OVERLAP_TOKENS = 40
+
+_TOKEN_RE = re.compile(r"[\u3400-\u9fff]|[^\s\u3400-\u9fff]+")
+
+
+def _is_cjk(ch):
+    return "\u3400" <= ch <= "\u9fff"
+
+
+def find_cut_points(audio, chunk_ms=CHUNK_MS, search_ms=SILENCE_SEARCH_MS,
+                    min_silence_ms=MIN_SILENCE_MS, silence_thresh_db=SILENCE_THRESH_DB):
+    from pydub.silence import detect_silence
+
+    # 只在每个目标切点附近检测静音，避免对整段长录音做逐毫秒扫描
+    thresh = audio.dBFS + silence_thresh_db
+    cuts = []
+    target = chunk_ms
+    while target < len(audio) - search_ms:
+        lo = max(target - search_ms, (cuts[-1] if cuts else 0) + min_silence_ms)
+        hi = min(target + search_ms, len(audio))
+        silences = detect_silence(audio[lo:hi], min_silence_len=min_silence_ms,
+                                  silence_thresh=thresh, seek_step=10)
+        if silences:
+            # 选择离目标切点最近的静音段，在其中点切开
+            start, end = min(silences, key=lambda s: abs(lo + (s[0] + s[1]) // 2 - target))
+            cut = lo + (start + end) // 2
+        else:
+            cut = target
+        cuts.append(cut)
+        target = cut + chunk_ms
+    return cuts
+
+
+def plan_chunks(duration_ms, cuts, overlap_ms=OVERLAP_MS):
+    bounds = [0] + list(cuts) + [duration_ms]
+    return [(max(bounds[i] - overlap_ms, 0), bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+
+def _tokens(text):
+    return [(m.group().lower().strip(".,!?;:，。！？；：、…\"'"), m.end()) for m in _TOKEN_RE.finditer(text)]
+
+
+def merge_overlap(previous, current, max_tokens=MAX_OVERLAP_TOKENS, min_tokens=2):
+    # 去掉 current 开头与 previous 结尾重复的部分（重叠区域被转录了两次）
+    prev_tokens = [t for t, _ in _tokens(previous)[-max_tokens:]]
+    cur_tokens = _tokens(current)[:max_tokens]
+    for k in range(min(len(prev_tokens), len(cur_tokens)), min_tokens - 1, -1):
+        if prev_tokens[-k:] == [t for t, _ in cur_tokens[:k]]:
+            return current[cur_tokens[k - 1][1]:].lstrip()
+    return current.strip()
+
+
+def stitch_transcripts(texts):
+    result = ""
+    for text in texts:
+        text = (text or "").strip()
+        if not text:
+            continue
+        if not result:
+            result = text
+            continue
+        tail = merge_overlap(result, text)
+        if tail:
+            sep = "" if _is_cjk(result[-1]) or _is_cjk(tail[0]) else " "
+            result = result + sep + tail
+    return result
+
+
+def transcribe_chunk(client, data, name, model="whisper-1", retries=MAX_RETRIES, backoff=RETRY_BACKOFF):
+    # 单段失败时只重试这一段，不重做整段录音
+    for attempt in range(retries + 1):
+        try:
+            with timed("api", api="transcription") as stats:
+                stats["bytes"] = len(data)
+                resp = client.audio.transcriptions.create(file=(name, data), model=model)
+            return resp.text
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * (2 ** attempt))
+
+
+def _export_chunk(audio, start, end):
+    buf = BytesIO()
+    # Whisper 内部使用 16kHz 单声道，先降采样以控制上传大小
+    audio[start:end].set_frame_rate(16000).set_channels(1).export(buf, format="wav")
+    return buf.getvalue()
+
+
+def transcribe_long_audio(client, audio_path, model="whisper-1", chunk_ms=CHUNK_MS,
+                          overlap_ms=OVERLAP_MS, max_workers=MAX_WORKERS, retries=MAX_RETRIES):
+    from pydub import AudioSegment
+    from pydub.exceptions import CouldntDecodeError
+
+    try:
+        audio = AudioSegment.from_file(audio_path)
+    except (CouldntDecodeError, OSError):
+        audio = None
+
+    # 短录音（或无法解码）直接整段上传
+    if audio is None or len(audio) <= chunk_ms + overlap_ms:
+        with open(audio_path, 'rb') as f:
+            return transcribe_chunk(client, f.read(), os.path.basename(audio_path), model, retries)
+
+    chunks = plan_chunks(len(audio), find_cut_points(audio, chunk_ms), overlap_ms)
+
+    def run(i, start, end):
+        return transcribe_chunk(client, _export_chunk(audio, start, end), f"chunk_{i}.wav", model, retries)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(run, i, start, end) for i, (start, end) in enumerate(chunks)]
+        texts = [f.result() for f in futures]
+    return stitch_transcripts(texts)